@@ -0,0 +1,397 @@
+"""
+Offline end-to-end benchmark of EventBot with HttpListener.
+
+The bot runs with stubbed XMPP transport connected to in-process simulated users, Redis is started as a local
+redis-server subprocess (unless --redis is given) and postbacks are received by local webhook sink. The benchmark
+drives /question/, /message/ and /monitor_chatroom/ traffic through the HTTP API and reports throughput and
+latency percentiles.
+
+usage: benchmark.py [--questions N] [--messages N] [--rooms N] [--chat-messages N] ...
+"""
+import gevent.monkey
+gevent.monkey.patch_all()
+
+import argparse
+import itertools
+import logging
+import random
+import socket
+import subprocess
+import time
+from urlparse import parse_qsl
+
+import gevent
+import redis
+import requests
+import simplejson
+from gevent import pywsgi
+from gevent.event import Event
+from gevent.pool import Pool
+from sleekxmpp.stanza import Message
+
+from marie.eventbot import EventBot
+from marie.listeners.http import HttpListener
+
+log = logging.getLogger(__name__)
+
+BOT_JID = 'marie@bench.local'
+ROOM_DOMAIN = 'conference.bench.local'
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))]
+
+
+class RedisServer(object):
+    """Context manager running disposable redis-server without persistence"""
+
+    def __init__(self, executable='redis-server', startup_timeout=5):
+        self.port = free_port()
+        self._executable = executable
+        self._startup_timeout = startup_timeout
+        self._process = None
+
+    def __enter__(self):
+        self._process = subprocess.Popen([self._executable, '--port', str(self.port), '--bind', '127.0.0.1',
+                                          '--save', '', '--appendonly', 'no'],
+                                         stdout=open('/dev/null', 'w'), stderr=subprocess.STDOUT)
+        connection = redis.StrictRedis('127.0.0.1', self.port)
+        deadline = time.time() + self._startup_timeout
+        while True:
+            try:
+                connection.ping()
+                return self
+            except redis.ConnectionError:
+                if time.time() > deadline or self._process.poll() is not None:
+                    self.__exit__(None, None, None)
+                    raise RuntimeError('redis-server did not start')
+                gevent.sleep(0.05)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+
+
+class SimulatedNetwork(object):
+    """
+    In-process stand-in for XMPP server with simulated users.
+
+    Online users answer every question (message with thread) after `answer_delay` seconds, offline users
+    don't answer at all. Chat messages sent by the bot are recorded with the time of delivery.
+    """
+    def __init__(self, users, answer_delay=0.0):
+        self.bot = None
+        self.users = ['user%d@bench.local' % i for i in range(users)]
+        self.online = set()
+        self.rooms = set()
+        self.delivered = {}  # message body -> delivery time
+        self.delivered_count = 0
+        self._answer_delay = answer_delay
+        self._changed = Event()
+
+    def attach(self, bot):
+        self.bot = bot
+
+    def deliver(self, stanza):
+        """Called by the bot for every outgoing stanza, only chat messages are handled"""
+        if not isinstance(stanza, Message) or stanza['type'] != 'chat':
+            return
+
+        to = stanza['to'].bare
+        self.delivered_count += 1
+        self.delivered[stanza['body']] = time.time()
+        self._changed.set()
+
+        if stanza['thread'] and to in self.online:
+            gevent.spawn_later(self._answer_delay, self._answer, to, stanza['thread'])
+
+    def _answer(self, user, thread):
+        msg = self.bot.make_message(mto=self.bot.boundjid, mbody='answer', mtype='chat', mfrom=user)
+        msg['thread'] = thread
+        self.bot.event('message', msg, direct=True)
+
+    def set_status(self, user, status):
+        """Sends presence of the user, status is `available`, one of show values or `unavailable`"""
+        if status == 'unavailable':
+            presence = self.bot.make_presence(pfrom=user, pto=self.bot.boundjid, ptype='unavailable')
+            self.online.discard(user)
+        else:
+            presence = self.bot.make_presence(pfrom=user, pto=self.bot.boundjid,
+                                              pshow=None if status == 'available' else status)
+            self.online.add(user)
+
+        self.bot.event('changed_status', presence, direct=True)
+        if status == 'unavailable':
+            self.bot.event('got_offline', presence, direct=True)
+
+    def groupchat(self, room, nick, text):
+        msg = self.bot.make_message(mto=self.bot.boundjid, mbody=text, mtype='groupchat',
+                                    mfrom='%s/%s' % (room, nick))
+        self.bot.event('message', msg, direct=True)
+
+    def wait_delivered(self, bodies, timeout):
+        deadline = time.time() + timeout
+        while not all(body in self.delivered for body in bodies) and time.time() < deadline:
+            self._changed.clear()
+            self._changed.wait(min(1.0, max(deadline - time.time(), 0)))
+
+
+class FakeXMPPBot(EventBot):
+    """EventBot with stubbed transport, stanzas are exchanged with SimulatedNetwork instead of a server"""
+
+    def __init__(self, network, *args, **kwargs):
+        super(FakeXMPPBot, self).__init__(*args, **kwargs)
+        self.network = network
+        network.attach(self)
+
+    def connect(self, *args, **kwargs):
+        return True
+
+    def process(self, *args, **kwargs):
+        while not self.stop.is_set():
+            gevent.sleep(1)
+
+    def send(self, data, *args, **kwargs):
+        self.network.deliver(data)
+
+    def join_chat_room(self, room, nick, password=None):
+        self._active_nicknames.add(nick)
+        self.network.rooms.add(room)
+
+    def leave_chat_room(self, room, nick):
+        self.network.rooms.discard(room)
+
+
+class WebhookSink(object):
+    """Local WSGI server receiving postbacks, records the time every answer and chatroom message was received"""
+
+    def __init__(self):
+        self.port = free_port()
+        self.answers = {}  # question id -> time
+        self.chat_messages = {}  # message text -> time
+        self.requests = 0
+        self._changed = Event()
+        self._server = pywsgi.WSGIServer(('127.0.0.1', self.port), self, log=None)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.port
+
+    def start(self):
+        self._server.start()
+
+    def stop(self):
+        self._server.stop()
+
+    def __call__(self, environ, start_response):
+        now = time.time()
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        self.requests += 1
+
+        if environ.get('CONTENT_TYPE', '').startswith('application/json'):
+            items = simplejson.loads(body)
+        else:
+            items = [dict(parse_qsl(body))]
+
+        for item in items:
+            if item.get('type') == 'answer':
+                self.answers.setdefault(item['id'], now)
+            elif 'room' in item:
+                self.chat_messages.setdefault(item['text'], now)
+        self._changed.set()
+
+        start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '2')])
+        return ['OK']
+
+    def wait(self, received, keys, idle_timeout):
+        """Waits until all `keys` are in `received` or nothing arrives for `idle_timeout` seconds"""
+        keys = set(keys)
+        while not keys.issubset(received):
+            self._changed.clear()
+            if not self._changed.wait(idle_timeout):
+                break
+
+
+class Benchmark(object):
+    def __init__(self, network, sink, api_url, concurrency, idle_timeout):
+        self.network = network
+        self.sink = sink
+        self._api_url = api_url
+        self._pool = Pool(concurrency)
+        self._session = requests.Session()
+        self._idle_timeout = idle_timeout
+        self._counter = itertools.count()
+
+    def _post(self, path, data):
+        start = time.time()
+        r = self._session.post(self._api_url + path, data=simplejson.dumps(data),
+                               headers={'Content-Type': 'application/json'})
+        r.raise_for_status()
+        return time.time() - start
+
+    def _run_requests(self, requests_data):
+        """Sends (path, data) requests concurrently, returns list of send times and request latencies"""
+        sent = [None] * len(requests_data)
+        latencies = [None] * len(requests_data)
+
+        def _send(index, path, data):
+            sent[index] = time.time()
+            latencies[index] = self._post(path, data)
+
+        for index, (path, data) in enumerate(requests_data):
+            self._pool.spawn(_send, index, path, data)
+        self._pool.join()
+        return sent, latencies
+
+    def _report(self, name, count, started, finished, latencies, request_latencies):
+        duration = max(finished - started, 1e-9)
+        log.info('%-12s %6d/%-6d done in %7.3fs  %9.1f/s  p50 %7.2fms  p99 %7.2fms  (HTTP p50 %7.2fms  p99 %7.2fms)'
+                 % (name, len(latencies), count, duration, len(latencies) / duration,
+                    percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000,
+                    percentile(request_latencies, 0.5) * 1000, percentile(request_latencies, 0.99) * 1000))
+
+    def questions(self, count, timeout=0):
+        """Question to answer postback round trip"""
+        run = next(self._counter)
+        questions = [{'to': random.choice(self.network.users), 'text': 'Question %d?' % i,
+                      'id': 'bench-%d-%d' % (run, i), 'postback_url': self.sink.url, 'timeout': timeout}
+                     for i in range(count)]
+
+        started = time.time()
+        sent, request_latencies = self._run_requests([('/question/', data) for data in questions])
+        self.sink.wait(self.sink.answers, [data['id'] for data in questions], self._idle_timeout)
+
+        received = [(self.sink.answers[data['id']], sent_at) for data, sent_at in zip(questions, sent)
+                    if data['id'] in self.sink.answers]
+        finished = max([received_at for received_at, _ in received] or [time.time()])
+        self._report('questions', count, started, finished,
+                     [received_at - sent_at for received_at, sent_at in received], request_latencies)
+
+    def messages(self, count):
+        """Message delivery to the user"""
+        run = next(self._counter)
+        messages = [{'to': random.choice(self.network.users), 'text': 'bench-message-%d-%d' % (run, i)}
+                    for i in range(count)]
+
+        started = time.time()
+        sent, request_latencies = self._run_requests([('/message/', data) for data in messages])
+        self.network.wait_delivered([data['text'] for data in messages], self._idle_timeout)
+
+        delivered = [(self.network.delivered[data['text']], sent_at) for data, sent_at in zip(messages, sent)
+                     if data['text'] in self.network.delivered]
+        finished = max([delivered_at for delivered_at, _ in delivered] or [time.time()])
+        self._report('messages', count, started, finished,
+                     [delivered_at - sent_at for delivered_at, sent_at in delivered], request_latencies)
+
+    def chatrooms(self, rooms, count, batch_size=None, batch_interval=None):
+        """Chatroom message to postback round trip"""
+        run = next(self._counter)
+        room_names = ['bench%d-%d@%s' % (run, i, ROOM_DOMAIN) for i in range(rooms)]
+        _, request_latencies = self._run_requests([
+            ('/monitor_chatroom/', {'room': room, 'nickname': 'Marie', 'postback_url': self.sink.url,
+                                    'batch_size': batch_size, 'batch_interval': batch_interval})
+            for room in room_names])
+        gevent.sleep(0.5)  # let the registry reload monitored rooms
+
+        texts = ['bench-chat-%d-%d' % (run, i) for i in range(count)]
+        sent = {}
+        started = time.time()
+        for text in texts:
+            sent[text] = time.time()
+            self.network.groupchat(random.choice(room_names), 'someone', text)
+            gevent.sleep(0)
+        self.sink.wait(self.sink.chat_messages, texts, self._idle_timeout)
+
+        latencies = [self.sink.chat_messages[text] - sent[text] for text in texts if text in self.sink.chat_messages]
+        finished = max([self.sink.chat_messages[text] for text in texts if text in self.sink.chat_messages] or
+                       [time.time()])
+        self._report('chatrooms', count, started, finished, latencies, request_latencies)
+
+        self._run_requests([('/cancel_monitoring/', {'room': room}) for room in room_names])
+
+    def churn(self, rate):
+        """Toggles random users offline and online `rate` times per second"""
+        while True:
+            user = random.choice(self.network.users)
+            self.network.set_status(user, 'unavailable' if user in self.network.online else 'available')
+            gevent.sleep(1.0 / rate)
+
+
+def run(args, redis_port):
+    network = SimulatedNetwork(args.users, answer_delay=args.answer_delay)
+    redis_config = {'host': '127.0.0.1', 'port': redis_port, 'db': args.redis_db}
+    bot = FakeXMPPBot(network, BOT_JID, 'secret', redis_config=redis_config, send_rate=args.send_rate,
+                      send_burst=args.send_rate)
+    bot.storage.clear_database()
+
+    api_port = free_port()
+    listener = HttpListener(bot, api_port, address='127.0.0.1')
+    sink = WebhookSink()
+
+    sink.start()
+    bot.start()
+    listener.start()
+    gevent.sleep(0.5)
+
+    for user in network.users:
+        network.set_status(user, 'available')
+
+    benchmark = Benchmark(network, sink, 'http://127.0.0.1:%d' % api_port, args.concurrency, args.idle_timeout)
+    churn = gevent.spawn(benchmark.churn, args.churn) if args.churn else None
+    try:
+        if args.questions:
+            benchmark.questions(args.questions)
+        if args.messages:
+            benchmark.messages(args.messages)
+        if args.chat_messages:
+            benchmark.chatrooms(args.rooms, args.chat_messages, args.batch_size, args.batch_interval)
+    finally:
+        if churn is not None:
+            churn.kill()
+        listener.stop_processing()
+        bot.stop_processing()
+        bot.storage.close()
+        listener.kill()
+        bot.kill()
+        sink.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(message)s')
+    logging.getLogger('sleekxmpp').setLevel(logging.WARNING)
+
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark')
+    parser.add_argument('--users', type=int, default=1000, help='number of simulated users')
+    parser.add_argument('--questions', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--chat-messages', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, help='batch size of monitored rooms postbacks')
+    parser.add_argument('--batch-interval', type=int, help='batch interval (ms) of monitored rooms postbacks')
+    parser.add_argument('--answer-delay', type=float, default=0.0, help='seconds before simulated user answers')
+    parser.add_argument('--churn', type=float, default=0.0, help='presence changes per second during the run')
+    parser.add_argument('--concurrency', type=int, default=50, help='number of concurrent HTTP requests')
+    parser.add_argument('--send-rate', type=int, default=100000, help='outbound stanzas per second')
+    parser.add_argument('--idle-timeout', type=float, default=5.0,
+                        help='seconds without progress after which the scenario is finished')
+    parser.add_argument('--redis', type=int, metavar='PORT', help='use running redis-server on localhost')
+    parser.add_argument('--redis-db', type=int, default=15, help='Redis database, it is flushed before the run')
+    args = parser.parse_args()
+
+    if args.redis:
+        run(args, args.redis)
+    else:
+        with RedisServer() as server:
+            run(args, server.port)
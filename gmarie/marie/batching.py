@@ -0,0 +1,41 @@
+import gevent
+
+
+class MessageBatcher(object):
+    """
+    Buffers items per key and flushes them together.
+
+    Buffer is flushed by calling `callback(key, items)` when it reaches `size` items or when `interval`
+    milliseconds passed since the first buffered item, whichever comes first. Items are passed in the order
+    in which they were added.
+    """
+    def __init__(self, callback):
+        self._callback = callback
+        self._buffers = {}
+        self._timers = {}
+
+    def add(self, key, item, size, interval):
+        buffer = self._buffers.setdefault(key, [])
+        buffer.append(item)
+
+        if len(buffer) >= size:
+            self.flush(key)
+        elif key not in self._timers:
+            self._timers[key] = gevent.spawn_later(interval / 1000.0, self.flush, key)
+
+    def keys(self):
+        """Returns keys with buffered items"""
+        return self._buffers.keys()
+
+    def flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None and timer is not gevent.getcurrent():
+            timer.kill(block=False)
+
+        items = self._buffers.pop(key, None)
+        if items:
+            self._callback(key, items)
+
+    def flush_all(self):
+        for key in self._buffers.keys():
+            self.flush(key)
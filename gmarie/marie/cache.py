@@ -0,0 +1,106 @@
+import time
+import collections
+import gevent
+from gevent import Greenlet
+import redis
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    Size bounded LRU cache with time to live.
+
+    Values older than `ttl` seconds are treated as missing.
+    """
+    _missing = object()
+
+    def __init__(self, size, ttl):
+        self._size = size
+        self._ttl = ttl
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self._missing) is not self._missing
+
+    def get(self, key, default=None):
+        try:
+            stored, value = self._data.pop(key)
+        except KeyError:
+            return default
+
+        if stored + self._ttl < time.time():
+            return default
+
+        # move to the end (most recently used)
+        self._data[key] = (stored, value)
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = (time.time(), value)
+
+        while len(self._data) > self._size:
+            self._data.popitem(last=False)
+
+    def update(self, key, value):
+        """Replaces cached value but keeps its original age, does nothing when the key is not cached"""
+        try:
+            stored, _ = self._data[key]
+        except KeyError:
+            return
+        self._data[key] = (stored, value)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+class KeyspaceInvalidator(Greenlet):
+    """
+    Listens to Redis keyspace notifications and invalidates cached keys modified by other clients.
+
+    Tries to enable the notifications on server when they are disabled, otherwise the cache consistency
+    relies on TTL only.
+    """
+    REQUIRED_FLAGS = 'Kghx'
+
+    def __init__(self, cache, host='localhost', port=6379, db=0, reconnect_interval=1.0):
+        Greenlet.__init__(self)
+        self._cache = cache
+        self._connection = redis.StrictRedis(host, port, db)
+        self._db = int(db or 0)
+        self._reconnect_interval = reconnect_interval
+
+    def _enable_notifications(self):
+        try:
+            flags = self._connection.config_get('notify-keyspace-events').get('notify-keyspace-events', '')
+            missing = ''.join(f for f in self.REQUIRED_FLAGS if f not in flags)
+            if missing:
+                self._connection.config_set('notify-keyspace-events', flags + missing)
+        except redis.ResponseError as e:
+            log.warning('Cannot enable keyspace notifications (%s), cache relies on TTL only' % e)
+
+    def _run(self):
+        prefix = '__keyspace@%d__:' % self._db
+        self._enable_notifications()
+
+        while True:
+            try:
+                pubsub = self._connection.pubsub()
+                pubsub.psubscribe(prefix + '*')
+                for message in pubsub.listen():
+                    if message['type'] == 'pmessage':
+                        self._cache.invalidate(message['channel'][len(prefix):])
+            except redis.ConnectionError:
+                log.warning('Keyspace notifications connection lost, reconnecting')
+
+            # notifications may have been lost meanwhile
+            self._cache.clear()
+            gevent.sleep(self._reconnect_interval)
@@ -0,0 +1,73 @@
+import gevent
+from gevent import Greenlet
+import redis
+from marie.filters import ChatroomFilter
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ChatroomRegistry(Greenlet):
+    """
+    In-memory registry of monitored chatrooms.
+
+    Changes are written to storage and announced through Redis pub/sub, registries in other processes
+    reload the rooms when they receive the announcement. Filters of all rooms are recompiled on every change.
+    """
+    def __init__(self, storage, reconnect_interval=1.0):
+        Greenlet.__init__(self)
+        self._storage = storage
+        self._reconnect_interval = reconnect_interval
+        self._set_rooms(storage.get_chatrooms())
+
+    def __contains__(self, room):
+        return room in self._rooms
+
+    def __getitem__(self, room):
+        return self._rooms[room]
+
+    def get(self, room, default=None):
+        return self._rooms.get(room, default)
+
+    def items(self):
+        return self._rooms.items()
+
+    def keys(self):
+        return self._rooms.keys()
+
+    def accepts(self, room, nick, text):
+        """Returns True if the message passes filters of the room"""
+        return self._filter.accepts(room, nick, text)
+
+    def _set_rooms(self, rooms):
+        self._rooms = rooms
+        self._filter = ChatroomFilter(rooms)
+
+    def add(self, room, nick, password, postback_url, **options):
+        rooms = dict(self._rooms)
+        rooms[room] = self._storage.add_chatroom(room, nick, password, postback_url, **options)
+        self._set_rooms(rooms)
+        self._storage.publish_chatrooms_changed()
+
+    def delete(self, room):
+        self._storage.delete_chatroom(room)
+        rooms = dict(self._rooms)
+        rooms.pop(room, None)
+        self._set_rooms(rooms)
+        self._storage.publish_chatrooms_changed()
+
+    def reload(self):
+        self._set_rooms(self._storage.get_chatrooms())
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self._storage.subscribe_chatrooms_changed()
+                # changes could have been missed while not subscribed
+                self.reload()
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.reload()
+            except redis.ConnectionError:
+                log.warning('Chatroom notifications connection lost, reconnecting')
+            gevent.sleep(self._reconnect_interval)
@@ -0,0 +1,223 @@
+"""
+Multi-worker mode.
+
+Every worker is separate bot process with its own JID sharing the same Redis. Recipients (and monitored rooms) are
+assigned to workers by consistent hashing, so questions to the same user are always sent by the same worker
+and the answers come back to it. BotCluster provides the EventBot interface used by listeners (e.g. HttpListener)
+in the front process: commands are passed to the owning worker through its queue in Redis and events raised
+by the workers are passed back through the shared event queue.
+"""
+import bisect
+import collections
+import hashlib
+import gevent
+from gevent import Greenlet
+from marie.dispatch import EventDispatcher
+from marie.listeners import Listener
+
+import logging
+log = logging.getLogger(__name__)
+
+EVENTS_QUEUE = 'cluster_events'
+INBOX_QUEUE = 'cluster_inbox:%s'
+
+
+class HashRing(object):
+    """Consistent hashing ring, every node is placed on the ring `replicas` times"""
+
+    def __init__(self, nodes, replicas=100):
+        self._ring = []
+        for node in nodes:
+            for i in range(replicas):
+                self._ring.append((self._hash('%s:%d' % (node, i)), node))
+        self._ring.sort()
+        self._keys = [key for key, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        index = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[index][1]
+
+
+def _serialize_message(msg):
+    return {
+        'type': msg['type'],
+        'from': unicode(msg['from']),
+        'mucroom': unicode(msg['mucroom']),
+        'mucnick': unicode(msg['mucnick']),
+        'body': msg['body'],
+    }
+
+
+class ClusterWorker(Listener):
+    """
+    Worker side of the cluster, attached to EventBot running in worker process.
+
+    Executes commands sent by BotCluster and forwards bot events to the front process.
+    """
+    COMMANDS = ('send_question', 'send_questions', 'broadcast_question', 'send_chat_message', 'deliver_message',
+                'join_chat_room', 'leave_chat_room')
+
+    def __init__(self, xmpp, workers, batch_size=100):
+        super(ClusterWorker, self).__init__(xmpp)
+        self._ring = HashRing(workers)
+        self._batch_size = batch_size
+        self._storage = xmpp.storage
+        self._name = xmpp.boundjid.bare
+
+        self.xmpp.register_callback('answer_received', self._forward_event('answer_received'))
+        self.xmpp.register_callback('question_expired', self._forward_event('question_expired'))
+        self.xmpp.register_callback('groupchat_message_received', self._forward_groupchat_message)
+        self.xmpp.add_event_handler('session_start', self._xmpp_session_started)
+
+    def _forward_event(self, event):
+        def _forward(data):
+            self._storage.push_queue(EVENTS_QUEUE, [{'event': event, 'data': data}])
+        return _forward
+
+    def _forward_groupchat_message(self, msg):
+        self._storage.push_queue(EVENTS_QUEUE, [{'event': 'groupchat_message_received',
+                                                 'data': _serialize_message(msg)}])
+
+    def _xmpp_session_started(self, event):
+        # join monitored rooms owned by this worker
+        for room, data in self._storage.get_chatrooms().items():
+            if self._ring.get_node(room) == self._name:
+                self.xmpp.join_chat_room(room, data['nickname'], data['password'] or None)
+
+    def _execute(self, command):
+        if command['method'] not in self.COMMANDS:
+            log.warning('Ignoring unknown cluster command %s' % command['method'])
+            return
+        getattr(self.xmpp, command['method'])(*command['args'], **command['kwargs'])
+
+    def _run(self):
+        inbox = INBOX_QUEUE % self._name
+        self._storage.restore_queue(inbox, self._name)
+
+        while True:
+            try:
+                commands = self._storage.fetch_queue(inbox, self._name, self._batch_size, timeout=1)
+            except Exception:
+                log.exception('Error while fetching cluster commands')
+                gevent.sleep(1)
+                continue
+
+            for raw, command in commands:
+                try:
+                    self._execute(command)
+                except Exception:
+                    log.exception('Error while executing cluster command %s' % command['method'])
+            if commands:
+                self._storage.ack_queue(inbox, self._name, [raw for raw, _ in commands])
+
+
+class BotCluster(Greenlet):
+    """
+    Front side of the cluster, used in place of EventBot by listeners.
+
+    Questions and messages are routed to the worker owning the recipient, broadcasts are routed by question id
+    (the whole broadcast is sent by single worker using its roster). Session related event handlers are not
+    supported, workers join their monitored rooms themselves.
+    """
+    DURABLE_EVENTS = ('answer_received', 'question_expired')
+
+    def __init__(self, workers, storage, replicas=100, batch_size=100, dispatcher=None):
+        Greenlet.__init__(self)
+        self._ring = HashRing(workers, replicas)
+        self.storage = storage
+        self._batch_size = batch_size
+        self._events = collections.defaultdict(list)
+        self._dispatcher = EventDispatcher() if dispatcher is None else dispatcher
+
+    def get_worker(self, key):
+        return self._ring.get_node(key)
+
+    def register_callback(self, event, callback):
+        self._events[event].append(callback)
+
+    def add_event_handler(self, name, handler):
+        log.debug('Event handler for %s ignored in cluster mode' % name)
+
+    def _send(self, worker, method, *args, **kwargs):
+        self.storage.push_queue(INBOX_QUEUE % worker, [{'method': method, 'args': args, 'kwargs': kwargs}])
+
+    def send_question(self, to, text, question_id, **kwargs):
+        self._send(self.get_worker(to), 'send_question', to, text, question_id, **kwargs)
+
+    def send_questions(self, questions):
+        """Questions are passed to workers in one command per worker, returns list of statuses"""
+        by_worker = collections.defaultdict(list)
+        results = []
+        for data in questions:
+            try:
+                by_worker[self.get_worker(data['to'])].append(data)
+                results.append({'id': data['id'], 'to': data['to'], 'status': 'queued'})
+            except (KeyError, TypeError):
+                results.append({'status': 'error', 'error': 'Data missing needed attributes'})
+
+        for worker, worker_questions in by_worker.items():
+            self._send(worker, 'send_questions', worker_questions)
+        return results
+
+    def broadcast_question(self, text, question_id, **kwargs):
+        self._send(self.get_worker(question_id), 'broadcast_question', text, question_id, **kwargs)
+
+    def send_chat_message(self, to, text, **kwargs):
+        self._send(self.get_worker(to), 'send_chat_message', to, text, **kwargs)
+
+    def deliver_message(self, to, text, defer=False):
+        self._send(self.get_worker(to), 'deliver_message', to, text, defer=defer)
+        return 'queued'
+
+    def join_chat_room(self, room, nick, password=None):
+        self._send(self.get_worker(room), 'join_chat_room', room, nick, password)
+
+    def leave_chat_room(self, room, nick):
+        self._send(self.get_worker(room), 'leave_chat_room', room, nick)
+
+    def stop_processing(self):
+        self._dispatcher.stop()
+
+    def _run(self):
+        consumer = 'front'
+        self.storage.restore_queue(EVENTS_QUEUE, consumer)
+
+        while True:
+            try:
+                events = self.storage.fetch_queue(EVENTS_QUEUE, consumer, self._batch_size, timeout=1)
+            except Exception:
+                log.exception('Error while fetching cluster events')
+                gevent.sleep(1)
+                continue
+
+            acks = []
+            for raw, event in events:
+                name, data = event['event'], event['data']
+                callbacks = self._events[name]
+                key = None
+                if name == 'answer_received':
+                    data = tuple(data)  # (question, answer)
+                elif name == 'groupchat_message_received':
+                    key = data['mucroom']  # messages of the room are handled in order
+
+                done = None
+                if name in self.DURABLE_EVENTS and callbacks:
+                    # acknowledged after the callbacks handled the event, so it is delivered again after restart
+                    done = self._acknowledge(consumer, raw)
+                else:
+                    acks.append(raw)
+                self._dispatcher.dispatch(name, callbacks, data, key=key, done=done)
+            if acks:
+                self.storage.ack_queue(EVENTS_QUEUE, consumer, acks)
+
+    def _acknowledge(self, consumer, raw):
+        def _done(success):
+            if success:
+                self.storage.ack_queue(EVENTS_QUEUE, consumer, [raw])
+        return _done
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+import msgpack
+import simplejson
+
+# binary records start with zero byte, so they can't be confused with legacy JSON records
+MAGIC = '\x00Q'
+VERSION = 1
+
+# schema of typed fields, other fields are stored as is
+DATETIME_FIELDS = ('sent', 'expires')
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class RecordDecodeError(ValueError):
+    pass
+
+
+def _datetime_to_micro(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _msgpack_default(obj):
+    # datetimes outside the schema are stored as ISO strings as in legacy records
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError('Object of type %s with value of %s is not serializable' % (type(obj), repr(obj)))
+
+
+def encode_question(data):
+    """Encodes question into versioned binary record"""
+    record = dict(data)
+    for field in DATETIME_FIELDS:
+        if record.get(field) is not None:
+            record[field] = _datetime_to_micro(record[field])
+
+    return MAGIC + chr(VERSION) + msgpack.packb(record, default=_msgpack_default, encoding='utf-8')
+
+
+def is_legacy_record(value):
+    return not value.startswith(MAGIC)
+
+
+def _decode_legacy_json(value):
+    """JSON decode function with additional datetime parsing"""
+    data = simplejson.loads(value)
+
+    def decode_datetime(date_string):
+        for date_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+            try:
+                return datetime.strptime(date_string, date_format)
+            except ValueError:
+                pass
+        return date_string
+
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if isinstance(v, basestring):
+                data[k] = decode_datetime(v)
+    return data
+
+
+def decode_question(value):
+    """
+    Decodes question record.
+
+    Both binary and legacy JSON records are supported, raises RecordDecodeError for malformed records.
+    """
+    if is_legacy_record(value):
+        try:
+            return _decode_legacy_json(value)
+        except ValueError as e:
+            raise RecordDecodeError(str(e))
+
+    version = ord(value[len(MAGIC)])
+    if version != VERSION:
+        raise RecordDecodeError('Unsupported record version %d' % version)
+
+    try:
+        record = msgpack.unpackb(value[len(MAGIC) + 1:], encoding='utf-8')
+    except Exception as e:
+        raise RecordDecodeError(str(e))
+
+    for field in DATETIME_FIELDS:
+        if record.get(field) is not None:
+            record[field] = EPOCH + timedelta(microseconds=record[field])
+    return record
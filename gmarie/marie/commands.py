@@ -0,0 +1,84 @@
+import collections
+from gevent.pool import Pool
+from marie.utils import TokenBucket
+from marie import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+THROTTLED_COMMANDS = metrics.counter('marie_throttled_commands_total', 'Number of rejected bot commands')
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+class CommandExecutor(object):
+    """
+    Executes bot commands with concurrency and rate limits.
+
+    At most `max_concurrent` asynchronous commands run at once and at most `max_per_user` of them belong
+    to the same user. Every user can issue `rate` commands per second with bursts up to `burst` commands.
+    """
+    MAX_BUCKETS = 10000
+
+    def __init__(self, max_concurrent=50, max_per_user=2, rate=1.0, burst=5):
+        self._pool = Pool(max_concurrent)
+        self._max_per_user = max_per_user
+        self._rate = rate
+        self._burst = burst
+        self._buckets = {}
+        self._running = collections.defaultdict(int)
+
+    def _bucket(self, jid):
+        try:
+            return self._buckets[jid]
+        except KeyError:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                # forget users which are not limited at the moment
+                for key in [k for k, bucket in self._buckets.items() if bucket.full]:
+                    del self._buckets[key]
+            bucket = self._buckets[jid] = TokenBucket(self._rate, self._burst)
+            return bucket
+
+    def submit(self, jid, func, *args, **kwargs):
+        """
+        Runs the command, asynchronously unless `blocking` is set.
+
+        Returns None when the command was accepted, otherwise returns reason of the rejection which should
+        be sent to the user.
+        """
+        blocking = kwargs.pop('blocking', False)
+
+        if not self._bucket(jid).consume():
+            THROTTLED_COMMANDS.inc(reason='rate')
+            return "Too many commands, please slow down"
+
+        if blocking:
+            func(*args, **kwargs)
+            return None
+
+        if self._running[jid] >= self._max_per_user:
+            THROTTLED_COMMANDS.inc(reason='user_concurrency')
+            return "Your previous commands are still running, please wait"
+
+        if self._pool.full():
+            THROTTLED_COMMANDS.inc(reason='concurrency')
+            return "Bot is busy, please try again later"
+
+        self._running[jid] += 1
+        self._pool.spawn(self._run, jid, func, *args, **kwargs)
+        return None
+
+    def _run(self, jid, func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            log.exception('Error while executing command')
+        finally:
+            self._running[jid] -= 1
+            if not self._running[jid]:
+                del self._running[jid]
+
+    def stop(self):
+        self._pool.kill()
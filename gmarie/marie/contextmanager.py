@@ -7,6 +7,7 @@ class GeventJoinallManager(object):
     def __init__(self):
         super(GeventJoinallManager, self).__init__()
         self._greenlets = []
+        self._resources = []
 
     def __enter__(self):
         return self
@@ -15,10 +16,18 @@ class GeventJoinallManager(object):
         worker.start()
         self._greenlets.append(worker)
 
+    def close_on_exit(self, resource):
+        """Registers resource (e.g. storage) closed after all workers are stopped"""
+        self._resources.append(resource)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         try:
             gevent.joinall(self._greenlets)
         except KeyboardInterrupt:
             # stop all running listeners
             log.info('Shutting down')
-            map(lambda self: self.stop_processing(), self._greenlets)
\ No newline at end of file
+            map(lambda self: self.stop_processing(), self._greenlets)
+        finally:
+            # workers can write to the resources while stopping
+            for resource in self._resources:
+                resource.close()
\ No newline at end of file
@@ -1,111 +1,590 @@
-from datetime import datetime
+import inspect
+import time
 import simplejson
-from simplejson.scanner import JSONDecodeError
 import redis
+from marie.cache import LRUCache, KeyspaceInvalidator
+from marie.codec import encode_question, decode_question, is_legacy_record, RecordDecodeError
+from marie.storage import Storage, default_handler, to_timestamp
+from marie import metrics
 
+STORAGE_SECONDS = metrics.histogram('marie_storage_operation_seconds', 'Duration of storage operations')
 
-def default_handler(obj):
-    """Serialization handler with datetime addon"""
-    if hasattr(obj, 'isoformat'):
-        return obj.isoformat()
-    else:
-        raise TypeError('Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj)))
+# sets question and extends TTL of the hash to the given deadline, questions without deadline make the hash persistent,
+# new questions are counted in KEYS[2]
+SET_QUESTION_SCRIPT = """
+local ttl = redis.call('TTL', KEYS[1])
+if redis.call('HSET', KEYS[1], ARGV[1], ARGV[2]) == 1 then
+    redis.call('INCR', KEYS[2])
+end
+if ARGV[3] == '' then
+    redis.call('PERSIST', KEYS[1])
+elseif ttl == -2 or (ttl >= 0 and ttl < tonumber(ARGV[3]) - tonumber(ARGV[4])) then
+    redis.call('EXPIREAT', KEYS[1], ARGV[3])
+end
+"""
 
+# appends entries to the feed, cursors have to be assigned atomically with adding the entries, otherwise readers
+# could skip entries added out of order
+APPEND_FEED_SCRIPT = """
+local count = #ARGV - 1
+local last = redis.call('INCRBY', KEYS[2], count)
+for i = 2, #ARGV do
+    local cursor = last - count + i - 1
+    redis.call('ZADD', KEYS[1], cursor, cursor .. ':' .. ARGV[i])
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+return last
+"""
 
-class DataStorage(object):
+# loads and deletes questions given as JID and question id pairs, returns their values (false for missing questions)
+# and subtracts the deleted questions from the counter in KEYS[1]
+POP_QUESTIONS_SCRIPT = """
+local values = {}
+local deleted = 0
+for i = 1, #ARGV, 2 do
+    local value = redis.call('HGET', ARGV[i], ARGV[i + 1])
+    if value then
+        redis.call('HDEL', ARGV[i], ARGV[i + 1])
+        deleted = deleted + 1
+    end
+    values[#values + 1] = value
+end
+if deleted > 0 then
+    redis.call('DECRBY', KEYS[1], deleted)
+end
+return values
+"""
+
+
+@metrics.instrument_methods(STORAGE_SECONDS)
+class DataStorage(Storage):
+    """Redis storage engine"""
     _instance = None
-    ANSWER_KEY = '__answers'
-    MAPPING_KEY = '__question_mapping'
+    ANSWER_KEY = '__answer:%s'
+    MAPPING_KEY = '__mapping:%s'
+    LEGACY_KEYS = ('__answers', '__question_mapping')  # shared hashes used before per-user keys
     CHATROOMS_KEY = '__chatrooms'
+    CHATROOMS_CHANNEL = '__chatrooms_changed'
+    EXPIRY_KEY = '__expiry'
+    BROADCASTS_KEY = '__broadcasts'
+    DEAD_LETTERS_KEY = '__postback_dead_letters'
+    QUEUE_KEY = '__queue:%s'
+    PROCESSING_KEY = '__queue:%s:processing:%s'
+    DEFERRED_KEY = '__deferred:%s'
+    FEED_KEY = '__feed'
+    FEED_SEQUENCE_KEY = '__feed:sequence'
+    QUESTION_COUNT_KEY = '__questions:count'
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
-            cls._instance = super(DataStorage, cls).__new__(cls, *args, **kwargs)
+            cls._instance = super(DataStorage, cls).__new__(cls)
+            cls._instance._config = None
         return cls._instance
 
-    def __init__(self, host='localhost', port=6379, db=0):
-        self._connection = redis.StrictRedis(host, port, db)
+    def __init__(self, *args, **kwargs):
+        """
+        Takes the same arguments as `_connect`.
+
+        The storage is shared by the whole process, it is connected on first instantiation. Later instantiations
+        without arguments return the connected storage, ValueError is raised when different arguments are given.
+        """
+        config = inspect.getcallargs(self._connect, *args, **kwargs)
+        config.pop('self')
+
+        if self._config is not None:
+            if (args or kwargs) and config != self._config:
+                raise ValueError('DataStorage is already connected with different configuration')
+            return
+
+        self._config = config
+        self._connect(**config)
+
+    def _connect(self, host='localhost', port=6379, db=0, cache_size=0, cache_ttl=30, max_connections=50,
+                 pool_timeout=5, question_grace=Storage.QUESTION_GRACE):
+        """
+        Connections are taken from pool of up to `max_connections` connections, if all of them are in use
+        the greenlet waits up to `pool_timeout` seconds for a free one.
+
+        Question hashes are removed by Redis `question_grace` seconds after the furthest deadline of their questions,
+        so questions which were not expired by the ExpiryScheduler (e.g. because no bot was running for longer than
+        that) are lost without `question_expired` event. If None, the hashes are kept until all their questions are
+        expired or answered.
+
+        If `cache_size` is set, decoded questions of up to `cache_size` JIDs are cached in memory for `cache_ttl`
+        seconds. The cache is kept consistent using Redis keyspace notifications.
+        """
+        pool = redis.BlockingConnectionPool(host=host, port=port, db=db or 0, max_connections=max_connections,
+                                            timeout=pool_timeout)
+        self._connection = redis.StrictRedis(connection_pool=pool)
+        self._question_grace = question_grace
+        self._set_question_script = self._connection.register_script(SET_QUESTION_SCRIPT)
+        self._append_feed_script = self._connection.register_script(APPEND_FEED_SCRIPT)
+        self._pop_questions_script = self._connection.register_script(POP_QUESTIONS_SCRIPT)
+        self._recounted = 0
+
+        self._cache = None
+        if cache_size:
+            self._cache = LRUCache(cache_size, cache_ttl)
+            KeyspaceInvalidator(self._cache, host, port, db).start()
 
     def clear_database(self):
         self._connection.flushdb()
+        if self._cache is not None:
+            self._cache.clear()
 
-    def _decode_json(self, value):
-        """JSON decode function with additional datetime parsing"""
-        data = simplejson.loads(value)
+    def _update_cached_questions(self, jid, set_questions=None, delete_ids=()):
+        """Write-through update of cached questions, JIDs which are not cached are left alone"""
+        if self._cache is None:
+            return
 
-        def decode_datetime(date_string):
-            try:
-                v = datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%S.%f')
-                return v
-            except ValueError:
-                return date_string
-
-        if isinstance(data, dict):
-            for k, v in data.items():
-                if isinstance(v, basestring):
-                    data[k] = decode_datetime(v)
-        return data
+        questions = self._cache.get(jid)
+        if questions is None:
+            return
+
+        questions = dict(questions)
+        questions.update(set_questions or {})
+        for question_id in delete_ids:
+            questions.pop(question_id, None)
+        self._cache.update(jid, questions)
+
+    def _expiry_member(self, jid, question_id):
+        return simplejson.dumps([jid, question_id])
 
     def get_questions(self, jid):
         """Loads and deserializes all questions from database for the specified JID"""
+        if self._cache is not None:
+            questions = self._cache.get(jid)
+            if questions is not None:
+                return dict(questions)
+
         data = self._connection.hgetall(jid)
         try:
-            return {k: self._decode_json(v) for k, v in data.items()}
-        except JSONDecodeError:
+            questions = {k: decode_question(v) for k, v in data.items()}
+        except RecordDecodeError:
             self._connection.delete(jid)
-            return {}
+            questions = {}
+
+        if self._cache is not None:
+            self._cache.set(jid, questions)
+        return dict(questions)
+
+    def set_questions(self, questions):
+        """Adds multiple questions given as (jid, question_id, data) tuples in a single pipeline"""
+        pipe = self._connection.pipeline()
+        self._pipe_set_questions(pipe, questions)
+        pipe.execute()
+        self._cache_set_questions(questions)
+
+    def _pipe_set_questions(self, pipe, questions):
+        now = int(time.time())
+        for jid, question_id, data in questions:
+            expire_at = ''
+            if data.get('expires') is not None:
+                deadline = to_timestamp(data['expires'])
+                pipe.zadd(self.EXPIRY_KEY, deadline, self._expiry_member(jid, question_id))
+                if self._question_grace is not None:
+                    expire_at = int(deadline) + self._question_grace
+            self._set_question_script(keys=[jid, self.QUESTION_COUNT_KEY],
+                                      args=[question_id, encode_question(data), expire_at, now], client=pipe)
 
-    def set_question(self, jid, question_id, data):
-        """Adds new question to database"""
-        encoded_data = simplejson.dumps(data, default=default_handler)
-        self._connection.hset(jid, question_id, encoded_data)
+    def _cache_set_questions(self, questions):
+        for jid, question_id, data in questions:
+            self._update_cached_questions(jid, set_questions={question_id: dict(data)})
+
+    def add_broadcast(self, question_id, questions):
+        """
+        Adds question sent to multiple users.
+
+        Takes list of (jid, data) tuples, the questions and list of recipients are stored in a single pipeline.
+        """
+        questions = [(jid, question_id, data) for jid, data in questions]
+        pipe = self._connection.pipeline()
+        pipe.hset(self.BROADCASTS_KEY, question_id, simplejson.dumps([jid for jid, _, _ in questions]))
+        self._pipe_set_questions(pipe, questions)
+        pipe.execute()
+        self._cache_set_questions(questions)
+
+    def claim_broadcast(self, question_id):
+        """
+        Atomically removes broadcast and returns list of its recipients.
+
+        Returns None if the broadcast was already claimed (i.e. answered by another recipient).
+        """
+        pipe = self._connection.pipeline(transaction=True)
+        pipe.hget(self.BROADCASTS_KEY, question_id)
+        pipe.hdel(self.BROADCASTS_KEY, question_id)
+        data, deleted = pipe.execute()
+        if data is None or not deleted:
+            return None
+        return simplejson.loads(data)
+
+    def delete_broadcast_questions(self, question_id, recipients):
+        """Deletes broadcast question of all recipients in a single pipeline"""
+        pipe = self._connection.pipeline()
+        self._pipe_pop_questions(pipe, [(jid, question_id) for jid in recipients])
+        pipe.zrem(self.EXPIRY_KEY, *[self._expiry_member(jid, question_id) for jid in recipients])
+        pipe.execute()
+
+        for jid in recipients:
+            self._update_cached_questions(jid, delete_ids=(question_id,))
 
     def delete_questions(self, jid, *question_ids):
         """Deletes saved questions identified by questions_ids"""
-        self._connection.hdel(jid, *question_ids)
+        pipe = self._connection.pipeline()
+        self._pipe_pop_questions(pipe, [(jid, question_id) for question_id in question_ids])
+        pipe.zrem(self.EXPIRY_KEY, *[self._expiry_member(jid, question_id) for question_id in question_ids])
+        pipe.execute()
+        self._update_cached_questions(jid, delete_ids=question_ids)
+
+    def pop_questions(self, questions):
+        """
+        Atomically loads and deletes multiple questions in a single transaction.
+
+        Takes list of (jid, question_id) tuples and returns list of decoded questions in the same order,
+        None is returned for questions that no longer exist.
+        """
+        pipe = self._connection.pipeline(transaction=True)
+        self._pipe_pop_questions(pipe, questions)
+        pipe.zrem(self.EXPIRY_KEY, *[self._expiry_member(jid, question_id) for jid, question_id in questions])
+        values = pipe.execute()[0]
+
+        for jid, question_id in questions:
+            self._update_cached_questions(jid, delete_ids=(question_id,))
+
+        output = []
+        for data in values:
+            if data is None:
+                output.append(None)
+                continue
+            try:
+                output.append(decode_question(data))
+            except RecordDecodeError:
+                output.append(None)
+        return output
+
+    def _pipe_pop_questions(self, pipe, questions):
+        self._pop_questions_script(keys=[self.QUESTION_COUNT_KEY],
+                                   args=[value for question in questions for value in question], client=pipe)
+
+    def get_due_expiries(self, until, limit):
+        """
+        Returns list of (jid, question_id) tuples of questions which expire before `until` (UNIX timestamp).
 
-    def save_answer(self, jid, answer):
-        """Temporary storage for answer text when the multiple question dialog is displayed"""
-        self._connection.hset(name=self.ANSWER_KEY, key=jid, value=answer)
+        At most `limit` entries ordered by deadline are returned.
+        """
+        members = self._connection.zrangebyscore(self.EXPIRY_KEY, '-inf', until, start=0, num=limit)
+        return [tuple(simplejson.loads(member)) for member in members]
+
+    def next_expiry(self):
+        """Returns UNIX timestamp of the nearest question deadline or None if there is no such question"""
+        data = self._connection.zrange(self.EXPIRY_KEY, 0, 0, withscores=True)
+        if not data:
+            return None
+        return data[0][1]
+
+    def _question_keys(self, batch_size):
+        """Iterates over keys of all question hashes (all other keys are prefixed with `__`)"""
+        for key in self._connection.scan_iter(count=batch_size):
+            if not key.startswith('__') and self._connection.type(key) == 'hash':
+                yield key
+
+    def count_questions(self):
+        """
+        Returns number of pending questions kept in counter updated when questions are set or deleted.
+
+        The counter is initialized by counting all questions when it doesn't exist (e.g. data stored by older versions)
+        and corrected for question hashes expired by Redis by `sweep_question_count`.
+        """
+        count = self._connection.get(self.QUESTION_COUNT_KEY)
+        if count is None:
+            total = self._scan_question_count()
+            self._connection.setnx(self.QUESTION_COUNT_KEY, total)
+            return total
+        return max(int(count), 0)
+
+    def _scan_question_count(self, batch_size=1000):
+        """Counts all pending questions, keys are scanned incrementally in batches of `batch_size`"""
+        total = 0
+        keys = []
+        for key in self._connection.scan_iter(count=batch_size):
+            if not key.startswith('__'):
+                keys.append(key)
+            if len(keys) >= batch_size:
+                total += self._count_hash_fields(keys)
+                keys = []
+        return total + self._count_hash_fields(keys)
+
+    def _count_hash_fields(self, keys):
+        pipe = self._connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.hlen(key)
+        return sum(count for count in pipe.execute(raise_on_error=False) if isinstance(count, (int, long)))
+
+    def migrate_questions(self, batch_size=100):
+        """
+        Rewrites questions stored in legacy JSON format to binary records.
+
+        Each hash is rewritten in a transaction, so questions answered or expired meanwhile are not resurrected.
+        Returns number of migrated questions.
+        """
+        migrated = {}
 
-    def load_answer(self, jid):
-        """Loads saved answer text"""
-        return self._connection.hget(name=self.ANSWER_KEY, key=jid)
+        def _migrate(pipe, key):
+            legacy = {k: v for k, v in pipe.hgetall(key).items() if is_legacy_record(v)}
+            pipe.multi()
+            for question_id, value in legacy.items():
+                try:
+                    pipe.hset(key, question_id, encode_question(decode_question(value)))
+                except RecordDecodeError:
+                    pipe.hdel(key, question_id)
+            migrated[key] = len(legacy)  # overwritten when the transaction is retried
 
-    def delete_answer(self, jid):
-        """Deletes answer text"""
-        self._connection.hdel(self.ANSWER_KEY, jid)
+        for key in self._question_keys(batch_size):
+            self._connection.transaction(lambda pipe: _migrate(pipe, key), key)
+            if migrated[key] and self._cache is not None:
+                self._cache.invalidate(key)
+
+        return sum(migrated.values())
+
+    def sweep_expiries(self, cursor, count):
+        """
+        Removes expiry entries of questions which no longer exist, processes single SCAN batch.
+
+        Returns tuple of the next cursor (0 when the scan is finished) and number of removed entries.
+        """
+        cursor, members = self._connection.zscan(self.EXPIRY_KEY, cursor, count=count)
+        pipe = self._connection.pipeline(transaction=False)
+        for member, _ in members:
+            jid, question_id = simplejson.loads(member)
+            pipe.hexists(jid, question_id)
+        orphans = [member for (member, _), exists in zip(members, pipe.execute()) if not exists]
+        if orphans:
+            self._connection.zrem(self.EXPIRY_KEY, *orphans)
+        return cursor, len(orphans)
+
+    def sweep_broadcasts(self, cursor, count):
+        """Removes broadcasts none of the recipients has pending, see `sweep_expiries`"""
+        cursor, data = self._connection.hscan(self.BROADCASTS_KEY, cursor, count=count)
+        broadcasts = [(question_id, simplejson.loads(recipients)) for question_id, recipients in data.items()]
+        pipe = self._connection.pipeline(transaction=False)
+        for question_id, recipients in broadcasts:
+            for jid in recipients:
+                pipe.hexists(jid, question_id)
+        results = iter(pipe.execute())
+        orphans = [question_id for question_id, recipients in broadcasts
+                   if not any([next(results) for _ in recipients])]
+        if orphans:
+            self._connection.hdel(self.BROADCASTS_KEY, *orphans)
+        return cursor, len(orphans)
+
+    def sweep_question_keys(self, cursor, count):
+        """
+        Sets TTL of persistent question hashes whose questions all have a deadline (e.g. stored by older versions),
+        see `sweep_expiries`.
+        """
+        if self._question_grace is None:
+            return 0, 0
+
+        cursor, keys = self._connection.scan(cursor, count=count)
+        keys = [key for key in keys if not key.startswith('__')]
+        pipe = self._connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+            pipe.ttl(key)
+        results = pipe.execute()
+        persistent = [key for key, key_type, ttl in zip(keys, results[0::2], results[1::2])
+                      if key_type == 'hash' and ttl == -1]
+
+        updated = {}
+
+        def _expire(pipe, key):
+            try:
+                questions = [decode_question(v) for v in pipe.hvals(key)]
+            except RecordDecodeError:
+                questions = []
+            deadlines = [question.get('expires') for question in questions]
+            expire = bool(deadlines) and None not in deadlines
+            pipe.multi()
+            if expire:
+                pipe.expireat(key, int(to_timestamp(max(deadlines))) + self._question_grace)
+            updated[key] = expire  # overwritten when the transaction is retried
+
+        for key in persistent:
+            self._connection.transaction(lambda pipe: _expire(pipe, key), key)
+        return cursor, sum(updated.values())
+
+    def sweep_question_count(self, cursor, count):
+        """
+        Recounts pending questions and corrects the question counter when the scan is finished, see `sweep_expiries`.
+
+        The counter is not updated when question hashes are expired by Redis.
+        """
+        if not int(cursor):
+            self._recounted = 0
+        cursor, keys = self._connection.scan(cursor, count=count)
+        self._recounted += self._count_hash_fields([key for key in keys if not key.startswith('__')])
+        if not int(cursor):
+            self._connection.set(self.QUESTION_COUNT_KEY, self._recounted)
+        return cursor, 0
+
+    def sweep_legacy_hashes(self, cursor, count):
+        """
+        Removes shared answer and mapping hashes replaced by per-user keys in batches of `count` fields.
+
+        The cursor is non-zero while there are fields left.
+        """
+        removed = 0
+        for key in self.LEGACY_KEYS:
+            _, data = self._connection.hscan(key, 0, count=count)
+            if data:
+                removed += self._connection.hdel(key, *data.keys())
+        return int(bool(removed)), removed
+
+    def load_answer_and_mapping(self, jid):
+        """Loads saved answer text and questions mapping in a single round trip"""
+        answer, mapping = self._connection.mget(self.ANSWER_KEY % jid, self.MAPPING_KEY % jid)
+        return answer, {} if mapping is None else simplejson.loads(mapping)
+
+    def save_answer_and_mapping(self, jid, mapping, answer=None, expires=None):
+        """
+        Saves questions mapping and optionally answer text in a single round trip.
+
+        The dialog state is removed `question_grace` seconds (DIALOG_TTL if questions are kept without limit) after
+        `expires` (the furthest deadline of the questions) or after DIALOG_TTL seconds if not given.
+        """
+        pipe = self._connection.pipeline()
+        if answer is not None:
+            pipe.set(self.ANSWER_KEY % jid, answer)
+        pipe.set(self.MAPPING_KEY % jid, simplejson.dumps(mapping))
+        grace = self.DIALOG_TTL if self._question_grace is None else self._question_grace
+        for key in (self.ANSWER_KEY % jid, self.MAPPING_KEY % jid):
+            if expires is not None:
+                pipe.expireat(key, int(to_timestamp(expires)) + grace)
+            else:
+                pipe.expire(key, self.DIALOG_TTL)
+        pipe.execute()
+
+    def delete_answer_and_mapping(self, jid):
+        self._connection.delete(self.ANSWER_KEY % jid, self.MAPPING_KEY % jid)
+
+    def push_queue(self, queue, items):
+        """Appends items to the reliable queue in a single command"""
+        encoded = [simplejson.dumps(item, default=default_handler) for item in items]
+        if encoded:
+            self._connection.lpush(self.QUEUE_KEY % queue, *encoded)
+
+    def fetch_queue(self, queue, consumer, count, timeout=0):
+        """
+        Moves up to `count` oldest items from the queue to the processing list of the consumer.
+
+        Blocks for `timeout` seconds when the queue is empty. Returns list of (raw, item) tuples, raw value has to be
+        passed to ack_queue after the item is processed.
+        """
+        key = self.QUEUE_KEY % queue
+        processing = self.PROCESSING_KEY % (queue, consumer)
+        first = self._connection.brpoplpush(key, processing, timeout)
+        if first is None:
+            return []
+
+        pipe = self._connection.pipeline(transaction=False)
+        for _ in range(count - 1):
+            pipe.rpoplpush(key, processing)
+        raw_items = [first] + [raw for raw in pipe.execute() if raw is not None]
+        return [(raw, simplejson.loads(raw)) for raw in raw_items]
+
+    def ack_queue(self, queue, consumer, raw_items):
+        """Removes processed items from the processing list"""
+        processing = self.PROCESSING_KEY % (queue, consumer)
+        pipe = self._connection.pipeline(transaction=False)
+        for raw in raw_items:
+            pipe.lrem(processing, 1, raw)
+        pipe.execute()
+
+    def restore_queue(self, queue, consumer):
+        """Returns unacknowledged items of the consumer to the front of the queue (e.g. after restart)"""
+        key = self.QUEUE_KEY % queue
+        processing = self.PROCESSING_KEY % (queue, consumer)
+
+        def _restore(pipe):
+            raw_items = pipe.lrange(processing, 0, -1)  # newest first
+            pipe.multi()
+            if raw_items:
+                pipe.rpush(key, *raw_items)
+                pipe.delete(processing)
+
+        self._connection.transaction(_restore, processing)
+
+    def add_dead_letter(self, data):
+        """Saves undelivered postback, only last DEAD_LETTERS_LIMIT postbacks are kept"""
+        pipe = self._connection.pipeline()
+        pipe.lpush(self.DEAD_LETTERS_KEY, simplejson.dumps(data, default=default_handler))
+        pipe.ltrim(self.DEAD_LETTERS_KEY, 0, self.DEAD_LETTERS_LIMIT - 1)
+        pipe.execute()
+
+    def get_dead_letters(self, count=100):
+        """Loads last `count` undelivered postbacks"""
+        return [simplejson.loads(v) for v in self._connection.lrange(self.DEAD_LETTERS_KEY, 0, count - 1)]
+
+    def defer_messages(self, jid, items, ttl, max_length):
+        """
+        Parks messages for user until the user becomes available.
+
+        Only last `max_length` messages are kept, the whole queue is removed after `ttl` seconds without new messages.
+        """
+        key = self.DEFERRED_KEY % jid
+        pipe = self._connection.pipeline()
+        pipe.rpush(key, *[simplejson.dumps(item, default=default_handler) for item in items])
+        pipe.ltrim(key, -max_length, -1)
+        pipe.expire(key, ttl)
+        pipe.execute()
+
+    def pop_deferred_messages(self, jid):
+        """Atomically loads and removes all messages deferred for user, oldest first"""
+        key = self.DEFERRED_KEY % jid
+        pipe = self._connection.pipeline()
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        return [simplejson.loads(v) for v in pipe.execute()[0]]
+
+    def append_feed(self, entries):
+        """Appends entries to the feed, returns cursor of the last one, only last FEED_LIMIT entries are kept"""
+        if not entries:
+            return None
+        encoded = [simplejson.dumps(entry, default=default_handler) for entry in entries]
+        return self._append_feed_script(keys=[self.FEED_KEY, self.FEED_SEQUENCE_KEY],
+                                        args=[self.FEED_LIMIT] + encoded)
+
+    def read_feed(self, since, limit):
+        """Returns list of up to `limit` (cursor, entry) tuples of entries appended after cursor `since`"""
+        members = self._connection.zrangebyscore(self.FEED_KEY, '(%d' % since, '+inf', start=0, num=limit)
+        entries = []
+        for member in members:
+            cursor, _, data = member.partition(':')
+            entries.append((int(cursor), simplejson.loads(data)))
+        return entries
 
     def get_chatrooms(self):
         data = self._connection.hgetall(self.CHATROOMS_KEY)
         return {k: simplejson.loads(v) for k, v in data.items()}
 
-    def add_chatroom(self, room, nick, password, postback_url):
+    def add_chatroom(self, room, nick, password, postback_url, **options):
         data = {
             'nickname': nick,
             'password': password,
             'url': postback_url
         }
+        data.update(options)
         self._connection.hset(self.CHATROOMS_KEY, room, simplejson.dumps(data))
+        return data
 
     def delete_chatroom(self, room):
         self._connection.hdel(self.CHATROOMS_KEY, room)
 
-    def set_questions_mapping(self, jid, mapping):
-        """
-        Sets questions mapping used for multiple question dialog.
-
-        Mapping is in the format of number: question_id.
-        Example: {'1': 'test_question_id', '2': 'second_question'}
-        """
+    def publish_chatrooms_changed(self):
+        self._connection.publish(self.CHATROOMS_CHANNEL, 'changed')
 
-        encoded_mapping = simplejson.dumps(mapping)
-        self._connection.hset(self.MAPPING_KEY, jid, encoded_mapping)
-
-    def get_question_mapping(self, jid):
-        """Loads questions mapping used for multiple question dialog"""
-
-        data = self._connection.hget(self.MAPPING_KEY, jid)
-        if data is None:
-            return {}
-        return simplejson.loads(data)
+    def subscribe_chatrooms_changed(self):
+        """Returns PubSub object subscribed to chatroom change notifications"""
+        pubsub = self._connection.pubsub()
+        pubsub.subscribe(self.CHATROOMS_CHANNEL)
+        return pubsub
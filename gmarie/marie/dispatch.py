@@ -0,0 +1,181 @@
+import collections
+import gevent
+from gevent.event import Event
+from gevent.pool import Pool
+from marie import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+DISPATCHED_EVENTS = metrics.counter('marie_dispatched_events_total', 'Number of events accepted by dispatcher')
+REJECTED_EVENTS = metrics.counter('marie_rejected_events_total', 'Number of events dropped because of full queue')
+CALLBACK_ERRORS = metrics.counter('marie_event_callback_errors_total', 'Number of failed event callbacks')
+QUEUED_EVENTS = metrics.gauge('marie_queued_events', 'Number of events waiting for dispatch')
+RUNNING_CALLBACKS = metrics.gauge('marie_event_callbacks_running', 'Number of running event callbacks')
+
+
+class EventDispatcher(object):
+    """
+    Executes event callbacks in bounded pool of greenlets.
+
+    Every event type has its own queue of up to `queue_size` events, so flood of one event type (e.g. groupchat
+    messages) doesn't delay the others. When the queue is full, the `overflow` policy is applied:
+
+    block           caller waits until there is space in the queue
+    drop_oldest     the oldest queued event is dropped
+    reject          the new event is dropped
+
+    `overflow` applies to all event types except those in `event_overflow` (mapping of event name to policy).
+    Answers and expired questions are already removed from storage when the event is triggered, so they always
+    block by default instead of being dropped.
+
+    Events dispatched with a `key` (e.g. groupchat messages keyed by room) are processed one after another
+    in the order of dispatch, events with different keys and events without a key are processed concurrently.
+
+    If `done` is given to `dispatch`, it is called with True after all callbacks of the event succeeded or with
+    False if any of them failed, so the caller can remove data only after the event was handled. `stop` waits
+    for queued and running events before killing the pool.
+    """
+    OVERFLOW_POLICIES = ('block', 'drop_oldest', 'reject')
+    DEFAULT_EVENT_OVERFLOW = {
+        'answer_received': 'block',
+        'question_expired': 'block',
+    }
+
+    def __init__(self, pool_size=100, queue_size=1000, overflow='drop_oldest', event_overflow=None):
+        event_overflow = dict(self.DEFAULT_EVENT_OVERFLOW, **(event_overflow or {}))
+        for policy in [overflow] + list(event_overflow.values()):
+            if policy not in self.OVERFLOW_POLICIES:
+                raise ValueError('Unknown overflow policy %s' % policy)
+
+        self._pool = Pool(pool_size)
+        self._queue_size = queue_size
+        self._overflow = overflow
+        self._event_overflow = event_overflow
+        self._queues = {}
+        self._serial = {}  # (event name, key) -> events waiting for the one being processed
+        self._waiting = collections.Counter()  # number of events in _serial by event name
+        self._consumers = {}
+        self._not_empty = collections.defaultdict(Event)
+        self._not_full = collections.defaultdict(Event)
+
+    def dispatch(self, event_name, callbacks, data, key=None, done=None):
+        """Queues execution of all `callbacks` with `data` as argument, see class docstring for `key` and `done`"""
+        if not callbacks:
+            if done is not None:
+                done(True)
+            return
+
+        queue = self._queues.setdefault(event_name, collections.deque())
+        if self._queued(event_name) >= self._queue_size:
+            overflow = self._event_overflow.get(event_name, self._overflow)
+            if overflow == 'block':
+                while self._queued(event_name) >= self._queue_size:
+                    self._not_full[event_name].clear()
+                    self._not_full[event_name].wait()
+            elif overflow == 'drop_oldest' and queue:
+                dropped_done = queue.popleft()[3]
+                QUEUED_EVENTS.dec(event=event_name)
+                REJECTED_EVENTS.inc(event=event_name)
+                if dropped_done is not None:
+                    dropped_done(False)
+            else:
+                REJECTED_EVENTS.inc(event=event_name)
+                log.warning('Event queue for %s is full, event rejected' % event_name)
+                if done is not None:
+                    done(False)
+                return
+
+        queue.append((callbacks, data, key, done))
+        DISPATCHED_EVENTS.inc(event=event_name)
+        QUEUED_EVENTS.inc(event=event_name)
+        self._not_empty[event_name].set()
+
+        if event_name not in self._consumers:
+            self._consumers[event_name] = gevent.spawn(self._consume, event_name)
+
+    def _queued(self, event_name):
+        return len(self._queues[event_name]) + self._waiting[event_name]
+
+    def stop(self, timeout=10):
+        """Waits up to `timeout` seconds until queued and running events are processed, then kills the rest"""
+        with gevent.Timeout(timeout, False):
+            while any(self._queues.values()):
+                gevent.sleep(0.05)
+            self._pool.join()
+
+        pending = sum(self._queued(event_name) for event_name in self._queues) + len(self._pool)
+        if pending:
+            log.warning('Dispatcher stopped with %d unprocessed events' % pending)
+        for consumer in self._consumers.values():
+            consumer.kill()
+        self._pool.kill()
+
+    def _run_callback(self, event_name, callback, data):
+        """Returns False if the callback failed"""
+        RUNNING_CALLBACKS.inc(event=event_name)
+        try:
+            callback(data)
+            return True
+        except Exception:
+            CALLBACK_ERRORS.inc(event=event_name)
+            log.exception('Error in %s callback %r' % (event_name, callback))
+            return False
+        finally:
+            RUNNING_CALLBACKS.dec(event=event_name)
+
+    def _run_event(self, event_name, callbacks, data, done):
+        """Runs callbacks of the event one after another and reports the result to `done`"""
+        success = True
+        for callback in callbacks:
+            success = self._run_callback(event_name, callback, data) and success
+        if done is not None:
+            try:
+                done(success)
+            except Exception:
+                log.exception('Error while finishing %s event' % event_name)
+
+    def _consume(self, event_name):
+        queue = self._queues[event_name]
+        while True:
+            while not queue:
+                self._not_empty[event_name].clear()
+                self._not_empty[event_name].wait()
+
+            callbacks, data, key, done = queue.popleft()
+            if key is None:
+                QUEUED_EVENTS.dec(event=event_name)
+                self._not_full[event_name].set()
+                # blocks while the pool is full
+                if done is not None:
+                    self._pool.spawn(self._run_event, event_name, callbacks, data, done)
+                    continue
+                for callback in callbacks:
+                    self._pool.spawn(self._run_callback, event_name, callback, data)
+                continue
+
+            serial = (event_name, key)
+            if serial in self._serial:
+                # processed by the greenlet processing the previous event with the same key
+                self._serial[serial].append((callbacks, data, done))
+                self._waiting[event_name] += 1
+                continue
+
+            QUEUED_EVENTS.dec(event=event_name)
+            self._not_full[event_name].set()
+            self._serial[serial] = collections.deque()
+            self._pool.spawn(self._run_serial, event_name, serial, callbacks, data, done)
+
+    def _run_serial(self, event_name, serial, callbacks, data, done):
+        """Runs callbacks of events with the same key one after another"""
+        while True:
+            self._run_event(event_name, callbacks, data, done)
+
+            waiting = self._serial[serial]
+            if not waiting:
+                del self._serial[serial]
+                return
+            callbacks, data, done = waiting.popleft()
+            self._waiting[event_name] -= 1
+            QUEUED_EVENTS.dec(event=event_name)
+            self._not_full[event_name].set()
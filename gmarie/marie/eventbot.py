@@ -4,6 +4,7 @@ import gevent
 monkey.patch_all()
 
 import collections
+import time
 import logging
 log = logging.getLogger(__name__)
 
@@ -12,7 +13,17 @@ from redish import serialization
 from redish.client import Client
 
 from xmppbot import XMPPBot, bot_command
-from db import DataStorage
+from db import DataStorage, to_timestamp
+from expiry import ExpiryScheduler
+from sweeper import StorageSweeper
+from dispatch import EventDispatcher
+from routing import QuestionIndex
+from cache import LRUCache
+from marie import metrics
+
+STANZA_SECONDS = metrics.histogram('marie_stanza_handling_seconds', 'Duration of received message handling')
+CHATROOM_MESSAGES = metrics.counter('marie_chatroom_messages_total', 'Number of messages received in chatrooms')
+PENDING_QUESTIONS = metrics.gauge('marie_pending_questions', 'Number of questions waiting for answer')
 
 
 class EventBot(XMPPBot):
@@ -21,25 +32,58 @@ class EventBot(XMPPBot):
 
     Available events:
     answer_received     triggered after the eventbot received answer to particular question
-    question_expired    triggered when the question timeouted
+    question_expired    triggered when the question timeouted, once for the whole broadcast (with `recipients`)
     """
     REDIS_CONFIG = {
         'host': 'localhost',
         'port': 6379,
-        'db': ""
+        'db': "",
+        'cache_size': 0,  # number of JIDs with cached questions, 0 disables the cache
+        'cache_ttl': 30,
+        'max_connections': 50,  # size of the connection pool
+        'question_grace': 3600  # questions not expired this many seconds after deadline are dropped, None keeps them
     }
+    DEFERRED_TTL = 86400  # deferred messages of users which don't get online are dropped after one day
+    DEFERRED_MAX_LENGTH = 100
 
-    def __init__(self, jid, password, redis_config=None):
-        super(EventBot, self).__init__(jid, password)
+    def __init__(self, jid, password, redis_config=None, expiry_batch_size=100, dispatcher=None,
+                 command_executor=None, send_rate=20, send_burst=50, storage=None):
+        """
+        `storage` is the storage backend (e.g. MemoryStorage), Redis DataStorage configured by `redis_config`
+        is used if not specified.
+        `dispatcher` is EventDispatcher used to execute event callbacks and `command_executor` is CommandExecutor
+        used to run bot commands, instances with default limits are used if not specified.
+        Outgoing messages are limited to `send_rate` stanzas per second with bursts up to `send_burst` stanzas.
+        """
+        super(EventBot, self).__init__(jid, password, command_executor=command_executor, send_rate=send_rate,
+                                       send_burst=send_burst)
         self._events = collections.defaultdict(list)
+        self._dispatcher = EventDispatcher() if dispatcher is None else dispatcher
+        self._question_indexes = LRUCache(10000, 600)  # answer routing indexes of users with multiple questions
+        self._answering = set()  # (jid, question id) of answers whose callbacks haven't finished yet
 
         # Redis init
-        if redis_config is not None:
-            self.REDIS_CONFIG.update(redis_config)
-        self._storage = DataStorage(**self.REDIS_CONFIG)
+        if storage is None:
+            if redis_config is not None:
+                self.REDIS_CONFIG.update(redis_config)
+            storage = DataStorage(**self.REDIS_CONFIG)
+        self._storage = storage
+
+        # question expiration running in background
+        self._expiry_scheduler = ExpiryScheduler(self._storage, self._question_expired,
+                                                 batch_size=expiry_batch_size)
+        # orphaned storage entries are reclaimed in background
+        self._sweeper = StorageSweeper(self._storage)
 
         self.add_event_handler('got_offline', self._user_got_offline)
 
+        # read from the question counter, refreshed at most once per minute
+        PENDING_QUESTIONS.set_callback(self._storage.count_questions, cache_time=60)
+
+    @property
+    def storage(self):
+        return self._storage
+
     def register_callback(self, event, callback):
         """
         Register callback according to event name.
@@ -51,6 +95,78 @@ class EventBot(XMPPBot):
         """
         self._events[event].append(callback)
 
+    def _build_question(self, to, text, question_id, timeout=0, **kwargs):
+        question = {
+            'to': to,
+            'text': text,
+            'id': question_id,
+            'expires': datetime.now() + timedelta(seconds=timeout) if timeout else None,
+            'sent': datetime.now(),
+            'thread': unicode(question_id),  # answers sent in the same thread are routed to this question
+            'worker': self.boundjid.bare  # only the bot which sent the question handles the answer
+        }
+        question.update(**kwargs)
+        return question
+
+    def _is_eligible(self, jid, only_if_status=None):
+        """Checks that user is online, or in one of the statuses if comma separated `only_if_status` is given"""
+        status = self.get_user_status(jid=jid)
+        if only_if_status is not None:
+            return status in only_if_status.split(',')
+        return status not in (None, 'unavailable')
+
+    def _deliver_question(self, question):
+        """
+        Sends stored question to the user.
+
+        Returns `sent`, `skipped` if it was not sent because of `only_if_status` or `deferred` if it will be sent
+        when the user becomes eligible.
+        """
+        if question['expires'] is not None:
+            self._expiry_scheduler.notify(to_timestamp(question['expires']))
+
+        only_if_status = question.get('only_if_status')
+        if question.get('defer'):
+            if not self._is_eligible(question['to'], only_if_status):
+                self._storage.defer_messages(question['to'], [{'question': question['id']}], self.DEFERRED_TTL,
+                                             self.DEFERRED_MAX_LENGTH)
+                return 'deferred'
+        elif only_if_status is not None and not self._is_eligible(question['to'], only_if_status):
+            return 'skipped'
+
+        # send question to the user
+        self.send_chat_message(question['to'], question['text'], thread=question['thread'])
+        return 'sent'
+
+    def deliver_message(self, to, text, defer=False):
+        """
+        Send chat message to the user.
+
+        If `defer` is set and the user is offline, the message is sent when the user gets online.
+        Returns `sent` or `deferred`.
+        """
+        if defer and not self._is_eligible(to):
+            self._storage.defer_messages(to, [{'text': text}], self.DEFERRED_TTL, self.DEFERRED_MAX_LENGTH)
+            return 'deferred'
+
+        self.send_chat_message(to, text)
+        return 'sent'
+
+    def _send_deferred(self, jid):
+        """Sends messages and questions deferred for the user, the ones still not eligible are deferred again"""
+        questions = None
+        for item in self._storage.pop_deferred_messages(jid):
+            if 'question' not in item:
+                self.deliver_message(jid, item['text'], defer=True)
+                continue
+
+            if questions is None:
+                questions = self._storage.get_questions(jid)
+            # skip questions which expired in the meantime
+            question = questions.get(unicode(item['question']))
+            if question is not None:
+                self._deliver_question(question)
+
     def send_question(self, to, text, question_id, timeout=0, **kwargs):
         """
         Send question to the user.
@@ -61,49 +177,115 @@ class EventBot(XMPPBot):
         postback_url        used by http listener. If specified, the answer will be sent as HTTP POST to this address.
         only_if_status      takes comma separated list of statuses. If the actual user status is not specified in this
                             list then the question will be ignored.
+        defer               if set to True the question is not ignored, but sent when the user gets online (or into
+                            one of `only_if_status` statuses).
+        keywords            list (or comma separated string) of words identifying answers to this question when
+                            the user has multiple pending questions.
         """
-        question = {
-            'to': to,
-            'text': text,
-            'id': question_id,
-            'expires': datetime.now() + timedelta(seconds=timeout) if timeout else None,
-            'sent': datetime.now()
-        }
-        question.update(**kwargs)
-
+        question = self._build_question(to, text, question_id, timeout, **kwargs)
         self._storage.set_question(jid=to, question_id=question_id, data=question)
+        self._deliver_question(question)
 
-        # only_if_status checking
-        try:
-            statuses = question['only_if_status'].split(',')
-            if self.get_user_status(jid=to) not in statuses:
-                return
-        except KeyError:
-            pass
+    def send_questions(self, questions):
+        """
+        Send multiple questions at once, questions are stored in a single pipeline.
 
-        # send question to the user
-        self.send_chat_message(to, text)
+        Takes list of dicts with `to`, `text` and `id` keys and additional arguments supported by send_question.
+        Returns list of statuses (`sent`, `skipped`, `deferred` or `error`) in the same order.
+        """
+        results = [None] * len(questions)
+        built = []
+        for index, data in enumerate(questions):
+            try:
+                kwargs = {k: v for k, v in data.iteritems() if k not in ('to', 'text', 'id')}
+                built.append((index, self._build_question(data['to'], data['text'], data['id'], **kwargs)))
+            except (KeyError, TypeError, AttributeError):
+                results[index] = {'status': 'error', 'error': 'Data missing needed attributes'}
+
+        self._storage.set_questions([(question['to'], question['id'], question) for _, question in built])
+
+        for index, question in built:
+            status = self._deliver_question(question)
+            results[index] = {'id': question['id'], 'to': question['to'], 'status': status}
+
+        return results
+
+    def broadcast_question(self, text, question_id, to=None, group=None, timeout=0, first_answer_only=True, **kwargs):
+        """
+        Send question to multiple users.
+
+        Recipients are given as list (or comma separated string) of JIDs (`to`) and/or roster group name (`group`).
+        Supports the same additional kwargs as send_question, users not matching `only_if_status` are skipped
+        and the question is not stored for them. If `first_answer_only` is set, only the first answer triggers
+        `answer_received` and the question is withdrawn from other recipients, otherwise every answer triggers
+        the event.
+
+        Returns list of JIDs the question was sent to.
+        """
+        statuses = None
+        if 'only_if_status' in kwargs:
+            statuses = kwargs['only_if_status'].split(',')
+
+        if isinstance(to, basestring):
+            to = [jid.strip() for jid in to.split(',') if jid.strip()]
+        recipients = list(to or [])
+        if statuses is not None:
+            recipients = self.presence.filter(recipients, statuses)
+        if group is not None:
+            recipients.extend(self.get_group_members(group, statuses))
+
+        # skip duplicates
+        seen = set()
+        eligible = []
+        for jid in recipients:
+            if jid not in seen:
+                seen.add(jid)
+                eligible.append(jid)
+
+        if not eligible:
+            return []
+
+        kwargs.update(broadcast=True, first_answer_only=first_answer_only)
+        questions = [(jid, self._build_question(jid, text, question_id, timeout, **kwargs)) for jid in eligible]
+        self._storage.add_broadcast(question_id, questions)
+
+        if questions[0][1]['expires'] is not None:
+            self._expiry_scheduler.notify(to_timestamp(questions[0][1]['expires']))
+        thread = questions[0][1]['thread']
+        for jid in eligible:
+            self.send_chat_message(jid, text, thread=thread)
+
+        return eligible
 
     def log_chatgroup(self, room, nick=None, password=None):
         pass
 
     def stop_processing(self):
+        self._expiry_scheduler.kill()
+        self._sweeper.kill()
+        self._dispatcher.stop()
+        self._command_executor.stop()
+        self._outbound.stop()
         self.stop.set()
 
-    def _trigger_event(self, event_name, data):
-        for callback in self._events[event_name]:
-            gevent.spawn(callback, data)  # spawn another greenlet to execute callback (do not care about result)
+    def _trigger_event(self, event_name, data, key=None, done=None):
+        # callbacks are executed asynchronously, events with the same key in order
+        self._dispatcher.dispatch(event_name, self._events[event_name], data, key=key, done=done)
+
+    def _user_status_changed(self, presence):
+        jid = presence['from'].bare
+        previous = self.presence.get_status(jid)
+        super(EventBot, self)._user_status_changed(presence)
+        # presences repeating the same status (e.g. changed status text) can't make deferred messages deliverable
+        if self.presence.get_status(jid) != previous and self._is_eligible(jid):
+            self._send_deferred(jid)
 
     def _user_got_offline(self, presence):
-        # expire all questions which has `expire_on_offline` set to True
+        # expire all questions which has `expire_on_offline` set to True, only for this user in case of broadcasts
         jid = presence['from'].bare
         questions = self._storage.get_questions(jid)
-        for question_id, question in questions.items():
-            try:
-                if question['expire_on_offline']:
-                    self._handle_expired_question(question)
-            except KeyError:
-                pass
+        expired = [q for q in questions.values() if q.get('expire_on_offline')]
+        self._handle_expired_questions(expired, whole_broadcast=False)
 
     def _remove_question(self, question):
         """Removes question from redis"""
@@ -114,54 +296,83 @@ class EventBot(XMPPBot):
         self._storage.clear_database()
         return "Database reset, please restart bot application"
 
-    def _handle_expired_question(self, question):
+    @bot_command(name="migrate_storage", min_privilege='admin')
+    def _migrate_storage(self):
+        return "Migrated %d questions" % self._storage.migrate_questions()
+
+    def _question_expired(self, question):
+        """Called when the question deadline passed, the question is already removed from storage"""
+        if question.get('broadcast'):
+            # the broadcast expires once, by whichever of its questions is popped first
+            recipients = self._storage.claim_broadcast(question['id'])
+            if recipients is None:
+                # already expired or answered
+                return
+            self._storage.delete_broadcast_questions(question['id'], recipients)
+            question = dict(question, recipients=recipients)
         self._trigger_event('question_expired', question)
-        self._remove_question(question)
+
+    def _handle_expired_questions(self, questions, whole_broadcast=True):
+        # trigger the event only for questions which weren't already expired by the expiry scheduler
+        if not questions:
+            return
+        popped = self._storage.pop_questions([(question['to'], question['id']) for question in questions])
+        for question in popped:
+            if question is None:
+                continue
+            if whole_broadcast:
+                self._question_expired(question)
+            else:
+                self._trigger_event('question_expired', question)
+
+    def _get_question_index(self, jid, questions):
+        """Returns answer routing index, it is rebuilt only when the pending questions change"""
+        index = self._question_indexes.get(jid)
+        if index is None or index.signature != QuestionIndex.get_signature(questions):
+            index = QuestionIndex(questions)
+            self._question_indexes.set(jid, index)
+        return index
 
     def _handle_multiple_questions(self, jid, msg, questions):
-        choice_table = "To which question are you answering?"
-        answer = self._storage.load_answer(jid)
+        index = self._get_question_index(jid, questions)
+        answer, mapping = self._storage.load_answer_and_mapping(jid)
 
         # choices were already displayed
         if answer:
-            mapping = self._storage.get_question_mapping(jid)
-            try:
-                question_number = msg['body']
-                question_id = mapping[question_number]
-
-                saved_answer_text = self._storage.load_answer(jid)
-                self._storage.delete_answer(jid)
-                msg['body'] = unicode(saved_answer_text, encoding='utf-8')
-
+            question_id = mapping.get(msg['body'])
+            if question_id in questions:
+                self._storage.delete_answer_and_mapping(jid)
+                msg['body'] = unicode(answer, encoding='utf-8')
                 return self._handle_answer(question_id, questions[question_id], msg)
-            except (KeyError, ValueError):
-                if mapping is not None:
-                    choice_table = 'Wrong number received\n\n' + choice_table
-        else:
-            self._storage.save_answer(jid, msg['body'])
-
-        # save question mapping
-        mapping = {}
-        num = 1
 
-        for question_id in questions.keys():
-            mapping[num] = question_id
-            num += 1
+        # try to route the answer by thread, question id or keywords
+        question_id, text = index.resolve(msg)
+        if question_id is not None:
+            if answer:
+                self._storage.delete_answer_and_mapping(jid)
+            msg['body'] = text
+            return self._handle_answer(question_id, questions[question_id], msg)
 
-        # save mapping to database
-        self._storage.set_questions_mapping(jid, mapping)
-
-        def _generate_list(_mapping):
-            output = ""
-            for number, question_id in sorted(_mapping.items()):
-                output += u"\n[%d] %s [%s]" % (number, questions[question_id]['text'], question_id)
+        choice_table = "To which question are you answering?"
+        if answer:
+            choice_table = 'Wrong number received\n\n' + choice_table
 
-            return output
+        # save mapping (and answer text when displaying the choices for the first time) to database
+        if not answer or mapping != index.mapping:
+            self._storage.save_answer_and_mapping(jid, index.mapping, None if answer else msg['body'],
+                                                  expires=index.expires)
 
-        choice_table += _generate_list(mapping)
-        msg.reply(choice_table).send()
+        msg.reply(choice_table + index.menu).send()
 
     def _handle_answer(self, question_id, question, msg):
+        recipients = None
+        if question.get('broadcast') and question.get('first_answer_only'):
+            recipients = self._storage.claim_broadcast(question_id)
+            if recipients is None:
+                # already answered by another recipient
+                self._remove_question(question)
+                return
+
         # reply with confirm_text if present
         if 'confirm_text' in question:
             msg.reply(question['confirm_text']).send()
@@ -176,30 +387,58 @@ class EventBot(XMPPBot):
             'msg_thread': msg['id']
         }
 
-        self._trigger_event('answer_received', (question, answer))
-        self._remove_question(question)
+        # the question is removed only after the callbacks handled the answer (e.g. queued the postback), so the answer
+        # is not lost when the bot stops in the meantime, until then other answers to the question are ignored
+        key = (question['to'], question_id)
+        self._answering.add(key)
+
+        def _answer_handled(success):
+            self._answering.discard(key)
+            if not success:
+                log.warning('Answer to question %s was not handled, keeping the question' % question_id)
+            elif recipients is not None:
+                # removes also the answered question
+                self._storage.delete_broadcast_questions(question_id, recipients)
+            else:
+                self._remove_question(question)
+
+        self._trigger_event('answer_received', (question, answer), done=_answer_handled)
 
     def _message_received(self, msg):
+        start = time.time()
+        try:
+            self._handle_message(msg)
+        finally:
+            STANZA_SECONDS.observe(time.time() - start, type=msg['type'])
+
+    def _handle_message(self, msg):
         # trigger event on received groupchat
         if msg['type'] == 'groupchat':
-            self._trigger_event('groupchat_message_received', msg)
+            CHATROOM_MESSAGES.inc(room=msg['mucroom'])
+            self._trigger_event('groupchat_message_received', msg, key=msg['mucroom'])
 
         # handle answers
         if msg['type'] in ('chat', 'normal'):
             jid = msg['from'].bare
-            questions = self._storage.get_questions(jid)
+            worker = self.boundjid.bare
+            questions = {k: q for k, q in self._storage.get_questions(jid).items()
+                         if q.get('worker', worker) == worker and (q.get('to'), k) not in self._answering}
 
             if questions:
-                for question_id, question in questions.items():
-                    # handle expired questions
-                    if question['expires'] is not None and question['expires'] < datetime.now():
-                        self._handle_expired_question(question)
-                        continue
+                # handle expired questions
+                now = datetime.now()
+                expired = [k for k, q in questions.items() if q['expires'] is not None and q['expires'] < now]
+                self._handle_expired_questions([questions.pop(question_id) for question_id in expired])
 
                 if len(questions) > 1:
                     return self._handle_multiple_questions(jid, msg, questions)
-                else:
+                elif questions:
                     # only one question present - handle answer
                     question_id, question = questions.items()[0]
                     self._handle_answer(question_id, question, msg)
-        super(EventBot, self)._message_received(msg)
\ No newline at end of file
+        super(EventBot, self)._message_received(msg)
+
+    def _run(self):
+        self._expiry_scheduler.start()
+        self._sweeper.start()
+        super(EventBot, self)._run()
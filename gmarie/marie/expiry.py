@@ -0,0 +1,81 @@
+import heapq
+import time
+import gevent
+from gevent import Greenlet
+from gevent.event import Event
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ExpiryScheduler(Greenlet):
+    """
+    Background engine firing question expiration close to the question deadline.
+
+    Deadlines are persisted in the Redis sorted set maintained by DataStorage, so the schedule survives restarts
+    and is shared between processes. Local min-heap of known deadlines is used only to wake up on time without
+    polling Redis; deadlines scheduled by other processes are discovered every `poll_interval` seconds.
+    """
+    def __init__(self, storage, callback, batch_size=100, poll_interval=1.0):
+        Greenlet.__init__(self)
+        self._storage = storage
+        self._callback = callback
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._deadlines = []  # min-heap of UNIX timestamps
+        self._wakeup = Event()
+
+    def notify(self, deadline):
+        """Registers new deadline (UNIX timestamp), wakes up the scheduler if it is the nearest one"""
+        heapq.heappush(self._deadlines, deadline)
+        if self._deadlines[0] == deadline:
+            self._wakeup.set()
+
+    def _next_timeout(self, now):
+        # drop deadlines that were already processed
+        while self._deadlines and self._deadlines[0] <= now:
+            heapq.heappop(self._deadlines)
+
+        if self._deadlines:
+            return min(self._deadlines[0] - now, self._poll_interval)
+        return self._poll_interval
+
+    def _expire_due(self):
+        """Expires all due questions in batches, returns number of expired questions"""
+        expired = 0
+        while True:
+            due = self._storage.get_due_expiries(time.time(), self._batch_size)
+            if not due:
+                break
+
+            # questions are fetched and deleted in one transaction, the ones answered or expired elsewhere
+            # in the meantime are returned as None
+            for question in self._storage.pop_questions(due):
+                if question is not None:
+                    expired += 1
+                    self._callback(question)
+
+            if len(due) < self._batch_size:
+                break
+
+        return expired
+
+    def _run(self):
+        # pick up deadlines persisted before restart
+        deadline = self._storage.next_expiry()
+        if deadline is not None:
+            self.notify(deadline)
+
+        while True:
+            self._wakeup.clear()
+            timeout = self._next_timeout(time.time())
+            if timeout > 0:
+                self._wakeup.wait(timeout)
+
+            try:
+                expired = self._expire_due()
+                if expired:
+                    log.debug('Expired %d questions' % expired)
+            except Exception:
+                log.exception('Error while expiring questions')
+                gevent.sleep(self._poll_interval)
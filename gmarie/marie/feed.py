@@ -0,0 +1,83 @@
+import time
+from gevent import Greenlet
+from gevent.event import Event
+from marie import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+FEED_ENTRIES = metrics.counter('marie_feed_entries_total', 'Number of entries appended to the answer feed')
+
+
+class AnswerFeed(Greenlet):
+    """
+    Append-only log of answers and groupchat messages read by consumers using cursors.
+
+    Every consumer keeps the cursor of the last entry it has read, so any number of consumers can read the same
+    entries. Added entries are buffered and appended to storage in order by single greenlet, in batches of up
+    to `batch_size` entries at least every `flush_interval` seconds, so adding an entry never waits for storage.
+
+    Readers waiting for new entries are woken up by appends made in this process, entries appended by other
+    processes are picked up after at most `poll_interval` seconds.
+    """
+    def __init__(self, storage, poll_interval=1, batch_size=100, flush_interval=0.1):
+        Greenlet.__init__(self)
+        self._storage = storage
+        self._poll_interval = poll_interval
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._pending = []
+        self._full = Event()
+        self._appended = Event()
+
+    def add(self, entry):
+        """Buffers entry for appending, doesn't block"""
+        self._pending.append(entry)
+        if len(self._pending) >= self._batch_size:
+            self._full.set()
+
+    def flush(self):
+        """Appends buffered entries to storage"""
+        entries, self._pending = self._pending, []
+        if not entries:
+            return
+
+        try:
+            self._storage.append_feed(entries)
+        except Exception:
+            # retried with the next flush, keeping the order
+            self._pending[:0] = entries
+            raise
+        FEED_ENTRIES.inc(len(entries))
+
+        # the event is replaced, so the readers woken up by it don't have to clear it
+        appended, self._appended = self._appended, Event()
+        appended.set()
+
+    def stop(self):
+        self.kill()
+        self.flush()
+
+    def read(self, since, limit, timeout=0):
+        """
+        Returns list of up to `limit` (cursor, entry) tuples of entries appended after cursor `since`.
+
+        Waits at most `timeout` seconds for new entries if there are none.
+        """
+        deadline = time.time() + timeout
+        while True:
+            appended = self._appended
+            entries = self._storage.read_feed(since, limit)
+            remaining = deadline - time.time()
+            if entries or remaining <= 0:
+                return entries
+            appended.wait(min(remaining, self._poll_interval))
+
+    def _run(self):
+        while True:
+            self._full.wait(self._flush_interval)
+            self._full.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Error while appending to answer feed')
@@ -0,0 +1,154 @@
+import re
+
+import logging
+log = logging.getLogger(__name__)
+
+# patterns with group references or global flags change meaning when combined with other patterns
+UNCOMBINABLE_PATTERN = re.compile(r'\\[1-9]|\(\?[iLmsux]+\)')
+
+
+class AhoCorasick(object):
+    """
+    Aho-Corasick automaton finding all occurrences of many keywords in a single pass over the text.
+
+    Built from (keyword, value) pairs, `search` yields values of keywords found in the text. Keywords
+    are matched case-insensitively.
+    """
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]
+
+        for keyword, value in keywords:
+            state = 0
+            for char in keyword.lower():
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(set())
+                state = next_state
+            self._output[state].add(value)
+
+        # breadth first, so the failure links of shorter prefixes are known
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] |= self._output[self._fail[next_state]]
+                queue.append(next_state)
+        self._output = [frozenset(output) for output in self._output]
+
+    def search(self, text):
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for char in text.lower():
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for value in output[state]:
+                yield value
+
+
+def compile_patterns(patterns):
+    """Returns list of compiled regexes, patterns are combined into single regex if possible"""
+    if not patterns:
+        return []
+    if not any(UNCOMBINABLE_PATTERN.search(pattern) for pattern in patterns):
+        try:
+            return [re.compile('|'.join('(?:%s)' % pattern for pattern in patterns), re.UNICODE)]
+        except re.error:
+            pass
+    return [re.compile(pattern, re.UNICODE) for pattern in patterns]
+
+
+def parse_filters(data):
+    """
+    Returns filters of monitored chatroom given in request data or None if there are no filters.
+
+    Recognized options are `keywords`, `regexes` (lists of strings or single string), `allow_nicks`, `deny_nicks`
+    (lists of nicknames) and `mention` (message has to mention the bot). Raises ValueError if filters are invalid.
+    """
+    filters = {}
+    for option in ('keywords', 'regexes', 'allow_nicks', 'deny_nicks'):
+        values = data.get(option)
+        if not values:
+            continue
+        if isinstance(values, basestring):
+            values = [values]
+        if not isinstance(values, list) or not all(isinstance(value, basestring) and value for value in values):
+            raise ValueError("%s has to be list of non-empty strings" % option)
+        filters[option] = values
+
+    for pattern in filters.get('regexes', ()):
+        try:
+            re.compile(pattern, re.UNICODE)
+        except re.error as e:
+            raise ValueError("Invalid regex: %s" % e)
+
+    if data.get('mention') in (True, 'true', '1', 1):
+        filters['mention'] = True
+    return filters or None
+
+
+class RoomRules(object):
+    __slots__ = ('allow_nicks', 'deny_nicks', 'patterns', 'mention', 'has_content_rules')
+
+    def __init__(self, filters, nickname=None):
+        self.allow_nicks = frozenset(filters['allow_nicks']) if filters.get('allow_nicks') else None
+        self.deny_nicks = frozenset(filters.get('deny_nicks', ()))
+        self.patterns = compile_patterns(filters.get('regexes'))
+        self.mention = None
+        if filters.get('mention') and nickname:
+            # the nickname has to be a whole word, e.g. "Marie" is not mentioned by "Mariella"
+            self.mention = re.compile(r'(?<!\w)%s(?!\w)' % re.escape(nickname), re.UNICODE | re.IGNORECASE)
+        self.has_content_rules = bool(filters.get('keywords') or filters.get('regexes') or filters.get('mention'))
+
+
+class ChatroomFilter(object):
+    """
+    Filters of all monitored chatrooms compiled into single matcher.
+
+    Message passes if its sender is allowed (in `allow_nicks` if given and not in `deny_nicks`) and it contains
+    any of the keywords, matches any of the regexes or mentions the bot by its nickname as a whole word. Keywords
+    of all rooms are searched by single Aho-Corasick automaton and regexes of the room are combined into single
+    regex, so every message is scanned once regardless of the number of filters. Rooms without filters pass all
+    messages.
+    """
+    def __init__(self, rooms):
+        self._rules = {}
+        keywords = []
+        for room, data in rooms.items():
+            filters = data.get('filters')
+            if not filters:
+                continue
+            try:
+                self._rules[room] = RoomRules(filters, data.get('nickname'))
+            except re.error:
+                log.exception('Invalid filters of chatroom %s, passing all messages' % room)
+                continue
+            keywords.extend((keyword, room) for keyword in filters.get('keywords', ()))
+        self._keywords = AhoCorasick(keywords)
+
+    def accepts(self, room, nick, text):
+        rules = self._rules.get(room)
+        if rules is None:
+            return True
+        if rules.allow_nicks is not None and nick not in rules.allow_nicks:
+            return False
+        if nick in rules.deny_nicks:
+            return False
+        if not rules.has_content_rules:
+            return True
+
+        text = text or u''
+        if any(pattern.search(text) for pattern in rules.patterns):
+            return True
+        if rules.mention is not None and rules.mention.search(text):
+            return True
+        return any(value == room for value in self._keywords.search(text))
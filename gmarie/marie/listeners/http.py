@@ -1,19 +1,29 @@
-from marie.db import DataStorage
 import re
 from gevent import monkey
 monkey.patch_all()
 
 from datetime import timedelta, datetime
-from gevent import http, Greenlet, GreenletExit
+from gevent import pywsgi
 from urlparse import parse_qsl
-import grequests
 from marie.listeners import Listener
+from marie.postback import PostbackDispatcher
+from marie.batching import MessageBatcher
+from marie.chatrooms import ChatroomRegistry
+from marie.feed import AnswerFeed
+from marie.filters import parse_filters
+from marie import metrics
 import simplejson
 from simplejson.decoder import JSONDecodeError
 
 import logging
 log = logging.getLogger(__name__)
 
+HTTP_REQUESTS = metrics.counter('marie_http_requests_total', 'Number of received HTTP requests')
+HTTP_IN_FLIGHT = metrics.gauge('marie_http_requests_in_flight', 'Number of HTTP requests being processed')
+FILTERED_MESSAGES = metrics.counter('marie_chatroom_filtered_messages_total',
+                                    'Number of monitored chatroom messages by filtering result')
+FEED_READERS = metrics.gauge('marie_feed_readers', 'Number of open long-poll and streaming answer feed requests')
+
 
 class MethodNotAllowed(Exception):
     def __init__(self, allowed_methods, *args, **kwargs):
@@ -25,6 +35,10 @@ class BadRequestError(Exception):
     pass
 
 
+class RequestEntityTooLarge(Exception):
+    pass
+
+
 def http_additional_serialize(value):
     # convert timedelta to seconds
     if isinstance(value, timedelta):
@@ -35,11 +49,62 @@ def http_additional_serialize(value):
 
 
 class HttpListener(Listener):
-    def __init__(self, xmpp, port, address="0.0.0.0"):
+    """
+    HTTP API of the bot served by keep-alive WSGI server.
+
+    At most `max_in_flight` requests are processed at once, requests over the limit are rejected immediately
+    with 503 and Retry-After header. Request bodies larger than `max_body_size` bytes are rejected with 413.
+
+    Answers and messages from monitored chatrooms are also appended to the answer feed, which can be read with
+    long-poll `GET /answers?since=<cursor>` or streamed as Server-Sent Events from `GET /answers/stream`. These
+    requests don't count towards `max_in_flight`, at most `max_feed_readers` of them are open at once.
+    """
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_BATCH_INTERVAL = 1000  # ms
+    RETRY_AFTER = 1  # seconds
+    READ_CHUNK_SIZE = 65536
+    FEED_BATCH_SIZE = 100
+    FEED_MAX_BATCH_SIZE = 1000
+    FEED_POLL_TIMEOUT = 30  # seconds
+    FEED_MAX_POLL_TIMEOUT = 60
+    FEED_HEARTBEAT_INTERVAL = 15  # seconds, keeps idle streams open and detects disconnected clients
+
+    # (name, path pattern, allowed method), handled by `_route_<name>` methods
+    ROUTES = [
+        ('metrics', r'metrics/?$', 'GET'),
+        ('answers_stream', r'answers/stream/?$', 'GET'),
+        ('answers', r'answers/?$', 'GET'),
+        ('messages_batch', r'messages/batch/?$', 'POST'),
+        ('questions_batch', r'questions/batch/?$', 'POST'),
+        ('message', r'message/', 'POST'),
+        ('question', r'question/', 'POST'),
+        ('broadcast', r'broadcast/', 'POST'),
+        ('monitor_chatroom', r'monitor_chatroom/', 'POST'),
+        ('cancel_monitoring', r'cancel_monitoring/', None),
+        ('cancel_all_monitoring', r'cancel_all_monitoring/', None),
+    ]
+    # all routes are matched at once, the name of matching group identifies the route
+    _route_pattern = re.compile('^/(?:%s)' % '|'.join('(?P<%s>%s)' % (name, pattern) for name, pattern, _ in ROUTES))
+    _route_methods = {name: method for name, _, method in ROUTES}
+    # routes reading the answer feed, served outside of the in-flight limit
+    FEED_ROUTES = ('answers', 'answers_stream')
+
+    def __init__(self, xmpp, port, address="0.0.0.0", max_in_flight=1000, max_body_size=10 * 1024 * 1024,
+                 max_feed_readers=1000):
         super(HttpListener, self).__init__(xmpp)
         self._port = port
         self._address = address
-        self._storage = DataStorage()
+        self._max_in_flight = max_in_flight
+        self._max_body_size = max_body_size
+        self._max_feed_readers = max_feed_readers
+        self._in_flight = 0
+        self._feed_readers = 0
+        self._server = None
+        self._storage = xmpp.storage
+        self._postbacks = PostbackDispatcher(self._storage)
+        self._batcher = MessageBatcher(self._send_message_batch)
+        self._chatrooms = ChatroomRegistry(self._storage)
+        self._feed = AnswerFeed(self._storage)
 
         self.xmpp.register_callback('answer_received', self.answer_received)
         self.xmpp.register_callback('groupchat_message_received', self._handle_groupchat_message)
@@ -47,15 +112,37 @@ class HttpListener(Listener):
 
     def _xmpp_session_started(self, event):
         # join monitored rooms
-        for room, data in self._storage.get_chatrooms().items():
+        for room, data in self._chatrooms.items():
             password = None if not data['password'] else data['password']
             self.xmpp.join_chat_room(room, data['nickname'], password)
 
-    def _get_postdata(self, request, headers):
-        # get input data from buffer
-        data = "".join(part for part in request.input_buffer)
-
-        if headers.get('content-type') == 'application/x-www-form-urlencoded':
+    def _read_body(self, environ):
+        """Reads request body in chunks, raises RequestEntityTooLarge when it exceeds the size limit"""
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise BadRequestError("Invalid Content-Length")
+        if length > self._max_body_size:
+            raise RequestEntityTooLarge()
+
+        stream = environ['wsgi.input']
+        if length:
+            return stream.read(length)
+
+        # chunked transfer encoding, the size is not known in advance
+        chunks = []
+        size = 0
+        while True:
+            chunk = stream.read(self.READ_CHUNK_SIZE)
+            if not chunk:
+                return ''.join(chunks)
+            size += len(chunk)
+            if size > self._max_body_size:
+                raise RequestEntityTooLarge()
+            chunks.append(chunk)
+
+    def _get_postdata(self, data, content_type):
+        if content_type == 'application/x-www-form-urlencoded':
             qs = parse_qsl(data)
             postdata = {}
             for k, v in qs:
@@ -81,26 +168,22 @@ class HttpListener(Listener):
 
         log.debug('Answer received: %s' % repr(answer))
 
-        # send answer to `postback_url`
-        try:
-            if question['postback_url']:
-                # serialize values inside the dictionary
-                postdata = {k: http_additional_serialize(v) for k, v in answer.iteritems()}
-                r = grequests.post(question['postback_url'], data=postdata)
-                grequests.send(r)
-        except KeyError:
-            pass
+        # serialize values inside the dictionary
+        postdata = {k: http_additional_serialize(v) for k, v in answer.iteritems()}
 
-    def _check_allowed_method(self, request, allow):
-        if request.typestr != allow.upper():
-            raise MethodNotAllowed(allow.upper())
+        # send answer to `postback_url`
+        if question.get('postback_url'):
+            self._postbacks.submit(question['postback_url'], postdata)
+        self._feed.add(postdata)
 
     def _handle_groupchat_message(self, msg):
         """Handles messages received from group chat"""
-        chatrooms = self._storage.get_chatrooms()
-
         try:
-            data = chatrooms[msg['mucroom']]
+            data = self._chatrooms[msg['mucroom']]
+            if not self._chatrooms.accepts(msg['mucroom'], msg['mucnick'], msg['body']):
+                FILTERED_MESSAGES.inc(result='filtered')
+                return
+            FILTERED_MESSAGES.inc(result='accepted')
 
             # create message
             message = {
@@ -113,80 +196,270 @@ class HttpListener(Listener):
             postdata = {k: http_additional_serialize(v) for k, v in message.iteritems()}
 
             # send message to postback_url
-            try:
-                r = grequests.post(data['url'], data=postdata)
-                grequests.send(r)
-            except TypeError:
-                pass
+            if data['url']:
+                if data.get('batch_size') or data.get('batch_interval'):
+                    self._batcher.add((msg['mucroom'], data['url']), postdata,
+                                      data.get('batch_size') or self.DEFAULT_BATCH_SIZE,
+                                      data.get('batch_interval') or self.DEFAULT_BATCH_INTERVAL)
+                else:
+                    self._postbacks.submit(data['url'], postdata, ordering_key=postdata['room'])
+            # appended in batches in background
+            self._feed.add(dict(postdata, type='groupchat'))
         except KeyError:
             pass
 
-    def register_room_monitoring(self, room, nick, password, postback_url):
-        self._storage.add_chatroom(room, nick, password, postback_url)
+    def _send_message_batch(self, key, messages):
+        """Sends buffered groupchat messages as single JSON array"""
+        room, url = key
+        self._postbacks.submit(url, simplejson.dumps(messages), headers={'Content-Type': 'application/json'},
+                               ordering_key=unicode(room))
+
+    def register_room_monitoring(self, room, nick, password, postback_url, batch_size=None, batch_interval=None,
+                                 filters=None):
+        """
+        Registers monitored room, messages are appended to the answer feed and sent to `postback_url` if set.
+
+        Only messages passing `filters` (see `parse_filters`) are forwarded.
+
+        If `batch_size` or `batch_interval` (in milliseconds) is set, messages are sent in batches as JSON array
+        when `batch_size` messages are buffered or `batch_interval` passes, whichever comes first.
+        Messages (and batches) of the room are delivered one at a time in the order in which they were received.
+        """
+        self._chatrooms.add(room, nick, password, postback_url, batch_size=batch_size, batch_interval=batch_interval,
+                            filters=filters)
         self.xmpp.join_chat_room(room, nick, password)
 
     def deregister_room_monitoring(self, room):
         try:
             # try to get nickname from database
-            nickname = self._storage.get_chatrooms()[room]['nickname']
+            nickname = self._chatrooms[room]['nickname']
             self.xmpp.leave_chat_room(room, nickname)
         except KeyError:
             log.debug('Cannot left room %s' % room)
             pass
-        self._storage.delete_chatroom(room)
+        self._chatrooms.delete(room)
+
+        # send messages buffered for the room
+        for key in self._batcher.keys():
+            if key[0] == room:
+                self._batcher.flush(key)
 
-    def _handle_command(self, data, request):
+    def _send_messages(self, messages):
+        """Sends multiple messages, returns list of statuses"""
+        results = []
+        for data in messages:
+            try:
+                status = self.xmpp.deliver_message(data['to'], data['text'], defer=data.get('defer', False))
+                results.append({'to': data['to'], 'status': status})
+            except (KeyError, TypeError):
+                results.append({'status': 'error', 'error': 'Data missing needed attributes'})
+        return results
+
+    def _route_messages_batch(self, data):  # multiple messages
+        if not isinstance(data, list):
+            raise BadRequestError("JSON array expected")
+        return self._send_messages(data)
+
+    def _route_questions_batch(self, data):  # multiple questions
+        if not isinstance(data, list):
+            raise BadRequestError("JSON array expected")
+        return self.xmpp.send_questions(data)
+
+    def _route_message(self, data):
+        self.xmpp.deliver_message(data['to'], data['text'], defer=data.get('defer', False))
+
+    def _route_question(self, data):
+        additional_args = {k: v for k, v in data.iteritems() if k not in ('to', 'id', 'text')}
+        return self.xmpp.send_question(data['to'], data['text'], data['id'], **additional_args)
+
+    def _route_broadcast(self, data):  # question sent to multiple users
+        if 'to' not in data and 'group' not in data:
+            raise BadRequestError("Recipients (to or group) missing")
+
+        additional_args = {k: v for k, v in data.iteritems() if k not in ('text', 'id')}
+        return self.xmpp.broadcast_question(data['text'], data['id'], **additional_args)
+
+    def _route_monitor_chatroom(self, data):
+        password = None
         try:
-            if re.match(r'^/message/.*', request.uri):  # message
-                self._check_allowed_method(request, 'POST')
-
-                return self.xmpp.send_chat_message(data['to'], data['text'])
-            elif re.match(r'^/question/.*', request.uri):  # question
-                self._check_allowed_method(request, 'POST')
-
-                additional_args = {k: v for k, v in data.iteritems() if k not in ('to', 'id', 'text')}
-                return self.xmpp.send_question(data['to'], data['text'], data['id'], **additional_args)
-            elif re.match(r'^/monitor_chatroom/.*', request.uri):  # monitor chatroom
-                self._check_allowed_method(request, 'POST')
-                password = None
-                try:
-                    password = data['password']
-                except KeyError:
-                    pass
-                return self.register_room_monitoring(data['room'], data['nickname'], password, data['postback_url'])
-            elif re.match(r'^/cancel_monitoring/.*', request.uri):  # cancel chatroom monitoring
-                return self.deregister_room_monitoring(data['room'])
-            elif re.match(r'^/cancel_all_monitoring/.*', request.uri):  # cancel all chatrooms monitoring
-                for room in self._storage.get_chatrooms().keys():
-                    self.deregister_room_monitoring(room)
-                return
+            password = data['password']
+        except KeyError:
+            pass
+        try:
+            batch_size = int(data['batch_size']) if data.get('batch_size') else None
+            batch_interval = int(data['batch_interval']) if data.get('batch_interval') else None
+        except (TypeError, ValueError):
+            raise BadRequestError("Invalid batch_size or batch_interval")
+        try:
+            filters = parse_filters(data)
+        except ValueError as e:
+            raise BadRequestError(str(e))
+        return self.register_room_monitoring(data['room'], data['nickname'], password, data.get('postback_url'),
+                                             batch_size=batch_size, batch_interval=batch_interval, filters=filters)
+
+    def _route_cancel_monitoring(self, data):
+        return self.deregister_room_monitoring(data['room'])
+
+    def _route_cancel_all_monitoring(self, data):
+        for room in self._chatrooms.keys():
+            self.deregister_room_monitoring(room)
+
+    def _route_metrics(self, data):
+        return metrics.REGISTRY.render().encode('utf-8')
+
+    def _match_route(self, environ):
+        match = self._route_pattern.match(environ.get('PATH_INFO') or '/')
+        return match.lastgroup if match is not None else None
+
+    def _handle_command(self, route, environ):
+        if route is None:
+            raise BadRequestError("Uncrecognized command")
+
+        allowed_method = self._route_methods[route]
+        if allowed_method is not None and environ['REQUEST_METHOD'] != allowed_method:
+            raise MethodNotAllowed(allowed_method)
+
+        data = None
+        if route != 'metrics':
+            content_type = environ.get('CONTENT_TYPE', '').split(';')[0].strip()
+            data = self._get_postdata(self._read_body(environ), content_type)
+
+        try:
+            return getattr(self, '_route_' + route)(data)
         except KeyError:
             log.info('Ignoring unrecognized message')
             raise BadRequestError("Data missing needed attributes")
 
-        raise BadRequestError("Uncrecognized command")
+    @staticmethod
+    def _reply(start_response, status, body, content_type='text/html', headers=()):
+        start_response(status, [('Content-Type', content_type), ('Content-Length', str(len(body)))] + list(headers))
+        return [body]
 
-    def _handle_connection(self, request):
-        # convert headers to dict (throws out headers with same name)
-        headers = {}
-        for k, v in request.get_input_headers():
-            headers[k.lower()] = v
+    def _application(self, environ, start_response):
+        """WSGI application, responses always have Content-Length so the connections are kept alive"""
+        route = self._match_route(environ)
+        if route in self.FEED_ROUTES:
+            return self._handle_feed_request(route, environ, start_response)
 
-        postdata = self._get_postdata(request, headers)
+        if self._in_flight >= self._max_in_flight:
+            HTTP_REQUESTS.inc(result='overloaded')
+            return self._reply(start_response, '503 Service Unavailable', '<h1>Error: Service Unavailable</h1>',
+                               headers=[('Retry-After', str(self.RETRY_AFTER))])
 
-        # handle postdata
+        self._in_flight += 1
+        HTTP_IN_FLIGHT.inc()
         try:
-            self._handle_command(postdata, request)
+            return self._handle_request(route, environ, start_response)
+        finally:
+            self._in_flight -= 1
+            HTTP_IN_FLIGHT.dec()
+
+    def _handle_request(self, route, environ, start_response):
+        try:
+            result = self._handle_command(route, environ)
         except MethodNotAllowed as e:
-            request.add_output_header('Allow', e.allowed_methods)
-            request.add_output_header('Content-Type', 'text/html')
-            return request.send_reply(405, 'Method Not Allowed', '<h1>Error: Method not allowed</h1>')
+            HTTP_REQUESTS.inc(result='method_not_allowed')
+            return self._reply(start_response, '405 Method Not Allowed', '<h1>Error: Method not allowed</h1>',
+                               headers=[('Allow', e.allowed_methods)])
+        except RequestEntityTooLarge:
+            HTTP_REQUESTS.inc(result='too_large')
+            return self._reply(start_response, '413 Request Entity Too Large',
+                               '<h1>Error: Request Entity Too Large</h1>')
         except BadRequestError as e:
-            request.add_output_header('Content-Type', 'text/html')
-            return request.send_reply(400, 'Bad Request', '<h1>Error: Bad Request</h1>\n<p>%s</p>' % str(e))
+            HTTP_REQUESTS.inc(result='bad_request')
+            return self._reply(start_response, '400 Bad Request',
+                               '<h1>Error: Bad Request</h1>\n<p>%s</p>' % str(e))
+
+        HTTP_REQUESTS.inc(result='ok')
+        if route == 'metrics':
+            return self._reply(start_response, '200 OK', result, content_type='text/plain; version=0.0.4')
+
+        # batch commands respond with list of statuses
+        if isinstance(result, list):
+            return self._reply(start_response, '200 OK', simplejson.dumps(result), content_type='application/json')
+
+        return self._reply(start_response, '200 OK', 'OK')
 
-        request.send_reply(200, "OK", "OK")
+    def _parse_feed_query(self, environ):
+        """Returns tuple of cursor, batch size and poll timeout given in the query string"""
+        query = dict(parse_qsl(environ.get('QUERY_STRING', '')))
+        try:
+            # reconnecting EventSource sends id of the last received event with the original URL, so it has to
+            # take precedence over `since`
+            since = int(environ.get('HTTP_LAST_EVENT_ID') or query.get('since') or 0)
+            limit = min(int(query.get('limit') or self.FEED_BATCH_SIZE), self.FEED_MAX_BATCH_SIZE)
+            timeout = min(float(query.get('timeout') or self.FEED_POLL_TIMEOUT), self.FEED_MAX_POLL_TIMEOUT)
+        except ValueError:
+            raise BadRequestError("Invalid since, limit or timeout")
+        if since < 0 or limit <= 0 or timeout < 0:
+            raise BadRequestError("Invalid since, limit or timeout")
+        return since, limit, timeout
+
+    def _handle_feed_request(self, route, environ, start_response):
+        if environ['REQUEST_METHOD'] != 'GET':
+            HTTP_REQUESTS.inc(result='method_not_allowed')
+            return self._reply(start_response, '405 Method Not Allowed', '<h1>Error: Method not allowed</h1>',
+                               headers=[('Allow', 'GET')])
+        if self._feed_readers >= self._max_feed_readers:
+            HTTP_REQUESTS.inc(result='overloaded')
+            return self._reply(start_response, '503 Service Unavailable', '<h1>Error: Service Unavailable</h1>',
+                               headers=[('Retry-After', str(self.RETRY_AFTER))])
+        try:
+            since, limit, timeout = self._parse_feed_query(environ)
+        except BadRequestError as e:
+            HTTP_REQUESTS.inc(result='bad_request')
+            return self._reply(start_response, '400 Bad Request',
+                               '<h1>Error: Bad Request</h1>\n<p>%s</p>' % str(e))
+
+        HTTP_REQUESTS.inc(result='ok')
+        if route == 'answers_stream':
+            # no Content-Length, the response is sent with chunked transfer encoding
+            start_response('200 OK', [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache')])
+            return self._stream_feed(since, limit)
+
+        self._feed_readers += 1
+        FEED_READERS.inc()
+        try:
+            entries = self._feed.read(since, limit, timeout)
+        finally:
+            self._feed_readers -= 1
+            FEED_READERS.dec()
+
+        body = simplejson.dumps({
+            'cursor': entries[-1][0] if entries else since,
+            'entries': [dict(entry, cursor=cursor) for cursor, entry in entries]
+        })
+        return self._reply(start_response, '200 OK', body, content_type='application/json')
+
+    def _stream_feed(self, since, limit):
+        """Yields feed entries as Server-Sent Events until the client disconnects"""
+        self._feed_readers += 1
+        FEED_READERS.inc()
+        try:
+            yield ': connected\n\n'
+            while True:
+                entries = self._feed.read(since, limit, self.FEED_HEARTBEAT_INTERVAL)
+                if not entries:
+                    yield ': heartbeat\n\n'
+                    continue
+                since = entries[-1][0]
+                yield ''.join('id: %d\ndata: %s\n\n' % (cursor, simplejson.dumps(entry)) for cursor, entry in entries)
+        finally:
+            self._feed_readers -= 1
+            FEED_READERS.dec()
+
+    def stop_processing(self):
+        if self._server is not None:
+            self._server.stop()
+        self._chatrooms.kill()
+        self._batcher.flush_all()
+        self._postbacks.stop()
+        self._feed.stop()
 
     def _run(self):
+        self._chatrooms.start()
+        self._postbacks.start()
+        self._feed.start()
         log.info('HTTP Listener serving on %s:%d...' % (self._address, self._port))
-        http.HTTPServer((self._address, self._port), self._handle_connection).serve_forever()
\ No newline at end of file
+        self._server = pywsgi.WSGIServer((self._address, self._port), self._application, log=None)
+        self._server.serve_forever()
\ No newline at end of file
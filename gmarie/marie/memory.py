@@ -0,0 +1,529 @@
+import collections
+import heapq
+import itertools
+import os
+import time
+import gevent
+import msgpack
+import simplejson
+from gevent.event import Event
+from gevent.queue import Queue
+from marie.codec import encode_question, decode_question
+from marie.storage import Storage, default_handler, to_timestamp
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def _key(value):
+    """JIDs and question ids are kept as byte strings, the same way they are returned by Redis"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+class MemorySubscription(object):
+    """Chatroom change notifications delivered within the process"""
+
+    def __init__(self, subscribers):
+        self._subscribers = subscribers
+        self._queue = Queue()
+        subscribers.add(self._queue)
+
+    def listen(self):
+        while True:
+            yield self._queue.get()
+
+    def close(self):
+        self._subscribers.discard(self._queue)
+
+
+class MemoryStorage(Storage):
+    """
+    In-memory storage engine for single process deployments.
+
+    All data is kept in the process, so no operation needs a network round trip. If `path` is given, every change
+    is recorded in append-only journal which is written and flushed to disk every `sync_interval` seconds, so
+    only the changes of the last interval can be lost on crash. When the journal grows over `compact_size` bytes,
+    new journal is started and snapshot of the whole storage is written by a forked process, so serializing
+    the storage never blocks the bot. Journals included in the snapshot are removed afterwards. On startup
+    the snapshot is loaded and the newer journals are replayed.
+
+    State of the multiple question dialog is dropped `question_grace` seconds after the furthest deadline of its
+    questions.
+    """
+    SNAPSHOT_VERSION = 2
+    COMPACT_SIZE = 64 * 1024 * 1024
+    PURGE_INTERVAL = 60  # expired dialogs and deferred messages are removed from memory this often
+
+    def __init__(self, path=None, sync_interval=1, compact_size=COMPACT_SIZE, question_grace=Storage.QUESTION_GRACE):
+        self._path = path
+        self._sync_interval = sync_interval
+        self._compact_size = compact_size
+        self._question_grace = question_grace
+        self._subscribers = set()
+        self._journal = None
+        self._journal_buffer = []
+        self._compaction = None  # (pid, generation) of the process writing snapshot
+        self._reset()
+
+        if path is not None:
+            self._open_journal(self._load() + 1)
+        self._maintenance = gevent.spawn(self._maintenance_loop)
+
+    def _reset(self):
+        self._questions = {}  # jid -> {question_id: question}
+        self._expiries = {}  # (jid, question_id) -> deadline
+        self._expiry_heap = []  # (deadline, jid, question_id), entries not matching _expiries are stale
+        self._broadcasts = {}  # question_id -> recipients
+        self._dialogs = {}  # jid -> [answer, mapping, expire_at]
+        self._deferred = {}  # jid -> [items, expire_at]
+        self._queues = collections.defaultdict(collections.deque)
+        self._processing = collections.defaultdict(list)  # (queue, consumer) -> raw items
+        self._queue_events = collections.defaultdict(Event)
+        self._dead_letters = collections.deque(maxlen=self.DEAD_LETTERS_LIMIT)
+        self._feed = []  # raw entries, cursors are contiguous and end with _feed_sequence
+        self._feed_sequence = 0
+        self._chatrooms = {}
+
+    def _mutate(self, operation, *args):
+        """Applies change to the storage and records it in the journal"""
+        result = getattr(self, '_apply_' + operation)(*args)
+        if self._path is not None:
+            self._journal_buffer.append(msgpack.packb([operation, args], use_bin_type=True, default=default_handler))
+        return result
+
+    def clear_database(self):
+        self._mutate('clear')
+
+    def _apply_clear(self):
+        self._reset()
+
+    def close(self):
+        self._maintenance.kill()
+        if self._path is not None:
+            self._sync_journal()
+            self._journal.close()
+            if self._compaction is not None:
+                self._finish_compaction(os.waitpid(self._compaction[0], 0)[1])
+
+    # questions
+
+    def get_questions(self, jid):
+        return {question_id: dict(question) for question_id, question in self._questions.get(_key(jid), {}).items()}
+
+    def set_questions(self, questions):
+        questions = [(_key(jid), _key(question_id), data) for jid, question_id, data in questions]
+        self._apply_questions(questions)
+        if self._path is not None:
+            # typed binary records, so deadlines are replayed as datetimes
+            records = [(jid, question_id, encode_question(data)) for jid, question_id, data in questions]
+            self._journal_buffer.append(msgpack.packb(['questions', [records]], use_bin_type=True))
+
+    def _apply_questions(self, questions):
+        for jid, question_id, data in questions:
+            self._questions.setdefault(jid, {})[question_id] = dict(data)
+            if data.get('expires') is not None:
+                deadline = to_timestamp(data['expires'])
+                self._expiries[(jid, question_id)] = deadline
+                heapq.heappush(self._expiry_heap, (deadline, jid, question_id))
+            else:
+                self._expiries.pop((jid, question_id), None)
+
+    def add_broadcast(self, question_id, questions):
+        self._mutate('broadcast', _key(question_id), [_key(jid) for jid, _ in questions])
+        self.set_questions([(jid, question_id, data) for jid, data in questions])
+
+    def _apply_broadcast(self, question_id, recipients):
+        self._broadcasts[question_id] = recipients
+
+    def claim_broadcast(self, question_id):
+        return self._mutate('claim', _key(question_id))
+
+    def _apply_claim(self, question_id):
+        return self._broadcasts.pop(question_id, None)
+
+    def _pop(self, jid, question_id):
+        questions = self._questions.get(jid)
+        if not questions:
+            return None
+
+        question = questions.pop(question_id, None)
+        if not questions:
+            del self._questions[jid]
+        self._expiries.pop((jid, question_id), None)
+        return question
+
+    def _apply_pop(self, questions):
+        return [self._pop(jid, question_id) for jid, question_id in questions]
+
+    def delete_broadcast_questions(self, question_id, recipients):
+        self._mutate('pop', [(_key(jid), _key(question_id)) for jid in recipients])
+
+    def delete_questions(self, jid, *question_ids):
+        self._mutate('pop', [(_key(jid), _key(question_id)) for question_id in question_ids])
+
+    def pop_questions(self, questions):
+        return self._mutate('pop', [(_key(jid), _key(question_id)) for jid, question_id in questions])
+
+    def get_due_expiries(self, until, limit):
+        heap = self._expiry_heap
+        due = []
+        seen = set()
+        while heap and heap[0][0] <= until and len(due) < limit:
+            entry = heapq.heappop(heap)
+            member = entry[1:]
+            if self._expiries.get(member) == entry[0] and member not in seen:
+                seen.add(member)
+                due.append(entry)
+
+        # the entries are removed by pop_questions
+        for entry in due:
+            heapq.heappush(heap, entry)
+        return [entry[1:] for entry in due]
+
+    def next_expiry(self):
+        heap = self._expiry_heap
+        while heap and self._expiries.get(heap[0][1:]) != heap[0][0]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def count_questions(self):
+        return sum(len(questions) for questions in self._questions.values())
+
+    # multiple question dialog
+
+    def _get_unexpired(self, data, key):
+        entry = data.get(key)
+        if entry is not None and entry[-1] < time.time():
+            del data[key]
+            return None
+        return entry
+
+    def load_answer_and_mapping(self, jid):
+        entry = self._get_unexpired(self._dialogs, _key(jid))
+        if entry is None:
+            return None, {}
+        return entry[0], dict(entry[1])
+
+    def save_answer_and_mapping(self, jid, mapping, answer=None, expires=None):
+        jid = _key(jid)
+        if expires is not None:
+            grace = self.DIALOG_TTL if self._question_grace is None else self._question_grace
+            expire_at = to_timestamp(expires) + grace
+        else:
+            expire_at = time.time() + self.DIALOG_TTL
+
+        if answer is None:
+            entry = self._get_unexpired(self._dialogs, jid)
+            answer = entry[0] if entry is not None else None
+        elif isinstance(answer, unicode):
+            answer = answer.encode('utf-8')  # returned as bytes, the same way as from Redis
+        self._mutate('dialog', jid, [answer, dict(mapping), expire_at])
+
+    def _apply_dialog(self, jid, entry):
+        self._dialogs[jid] = entry
+
+    def delete_answer_and_mapping(self, jid):
+        self._mutate('delete_dialog', _key(jid))
+
+    def _apply_delete_dialog(self, jid):
+        self._dialogs.pop(jid, None)
+
+    # deferred messages
+
+    def defer_messages(self, jid, items, ttl, max_length):
+        jid = _key(jid)
+        entry = self._get_unexpired(self._deferred, jid)
+        messages = list(entry[0]) if entry is not None else []
+        messages.extend(dict(item) for item in items)
+        del messages[:-max_length]
+        self._mutate('deferred', jid, [messages, time.time() + ttl])
+
+    def _apply_deferred(self, jid, entry):
+        self._deferred[jid] = entry
+
+    def pop_deferred_messages(self, jid):
+        jid = _key(jid)
+        entry = self._get_unexpired(self._deferred, jid)
+        if entry is None:
+            return []
+        self._mutate('delete_deferred', jid)
+        return entry[0]
+
+    def _apply_delete_deferred(self, jid):
+        self._deferred.pop(jid, None)
+
+    # reliable queues, items are serialized the same way as in Redis
+
+    def push_queue(self, queue, items):
+        self._mutate('push', queue, [simplejson.dumps(item, default=default_handler) for item in items])
+
+    def _apply_push(self, queue, raw_items):
+        self._queues[queue].extend(raw_items)
+        self._queue_events[queue].set()
+
+    def fetch_queue(self, queue, consumer, count, timeout=0):
+        items = self._queues[queue]
+        if not items:
+            event = self._queue_events[queue]
+            event.clear()
+            event.wait(timeout or None)
+            if not items:
+                return []
+
+        raw_items = self._mutate('fetch', queue, consumer, min(count, len(items)))
+        return [(raw, simplejson.loads(raw)) for raw in raw_items]
+
+    def _apply_fetch(self, queue, consumer, count):
+        items = self._queues[queue]
+        raw_items = [items.popleft() for _ in range(min(count, len(items)))]
+        self._processing[(queue, consumer)].extend(raw_items)
+        return raw_items
+
+    def ack_queue(self, queue, consumer, raw_items):
+        self._mutate('ack', queue, consumer, list(raw_items))
+
+    def _apply_ack(self, queue, consumer, raw_items):
+        processing = self._processing[(queue, consumer)]
+        for raw in raw_items:
+            try:
+                processing.remove(raw)
+            except ValueError:
+                pass
+
+    def restore_queue(self, queue, consumer):
+        if self._processing.get((queue, consumer)):
+            self._mutate('restore', queue, consumer)
+
+    def _apply_restore(self, queue, consumer):
+        raw_items = self._processing.pop((queue, consumer), [])
+        if raw_items:
+            self._queues[queue].extendleft(reversed(raw_items))
+            self._queue_events[queue].set()
+
+    def add_dead_letter(self, data):
+        self._mutate('dead_letter', simplejson.dumps(data, default=default_handler))
+
+    def _apply_dead_letter(self, raw):
+        self._dead_letters.appendleft(raw)
+
+    def get_dead_letters(self, count=100):
+        return [simplejson.loads(v) for v in itertools.islice(self._dead_letters, count)]
+
+    # answer feed
+
+    def append_feed(self, entries):
+        if not entries:
+            return None
+        return self._mutate('feed', [simplejson.dumps(entry, default=default_handler) for entry in entries])
+
+    def _apply_feed(self, raw_entries):
+        self._feed.extend(raw_entries)
+        self._feed_sequence += len(raw_entries)
+        # trimmed in chunks, so the list isn't shifted on every append
+        if len(self._feed) > self.FEED_LIMIT * 1.1:
+            del self._feed[:-self.FEED_LIMIT]
+        return self._feed_sequence
+
+    def read_feed(self, since, limit):
+        first = self._feed_sequence - len(self._feed) + 1
+        start = max(since - first + 1, 0)
+        return [(first + index, simplejson.loads(raw))
+                for index, raw in enumerate(self._feed[start:start + limit], start)]
+
+    # monitored chatrooms
+
+    def get_chatrooms(self):
+        return {room: dict(data) for room, data in self._chatrooms.items()}
+
+    def add_chatroom(self, room, nick, password, postback_url, **options):
+        data = {
+            'nickname': nick,
+            'password': password,
+            'url': postback_url
+        }
+        data.update(options)
+        self._mutate('chatroom', _key(room), dict(data))
+        return data
+
+    def _apply_chatroom(self, room, data):
+        self._chatrooms[room] = data
+
+    def delete_chatroom(self, room):
+        self._mutate('delete_chatroom', _key(room))
+
+    def _apply_delete_chatroom(self, room):
+        self._chatrooms.pop(room, None)
+
+    def publish_chatrooms_changed(self):
+        for queue in self._subscribers:
+            queue.put({'type': 'message', 'channel': 'chatrooms_changed', 'data': 'changed'})
+
+    def subscribe_chatrooms_changed(self):
+        return MemorySubscription(self._subscribers)
+
+    # persistence
+
+    def _purge_expired(self):
+        now = time.time()
+        for data in (self._dialogs, self._deferred):
+            for key in [key for key, entry in data.items() if entry[-1] < now]:
+                del data[key]
+
+    def _journal_path(self, generation):
+        return '%s.journal.%d' % (self._path, generation)
+
+    def _journal_generations(self):
+        directory, prefix = os.path.split(self._path + '.journal.')
+        suffixes = [name[len(prefix):] for name in os.listdir(directory or '.') if name.startswith(prefix)]
+        return sorted(int(suffix) for suffix in suffixes if suffix.isdigit())
+
+    def _open_journal(self, generation):
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._journal_path(generation), 'ab')
+        self._journal_size = 0
+        self._generation = generation
+
+    def _sync_journal(self):
+        """Appends the buffered changes to the journal and flushes it to disk"""
+        if not self._journal_buffer:
+            return
+        data = ''.join(self._journal_buffer)
+        self._journal_buffer = []
+        self._journal.write(data)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_size += len(data)
+
+    def _compact(self):
+        """Starts new journal and writes snapshot including all the previous journals in a forked process"""
+        self._sync_journal()
+        generation = self._generation + 1
+        self._open_journal(generation)
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._write_snapshot(generation)
+                status = 0
+            except Exception:
+                log.exception('Error while writing storage snapshot')
+            finally:
+                os._exit(status)
+        self._compaction = (pid, generation)
+
+    def _finish_compaction(self, status):
+        _, generation = self._compaction
+        self._compaction = None
+        if status != 0:
+            log.error('Writing storage snapshot failed with status %d, journals are kept' % status)
+            return
+        for old in self._journal_generations():
+            if old < generation:
+                os.remove(self._journal_path(old))
+
+    def _write_snapshot(self, generation):
+        state = {
+            'version': self.SNAPSHOT_VERSION,
+            'generation': generation,
+            'questions': {jid: {question_id: encode_question(question) for question_id, question in questions.items()}
+                          for jid, questions in self._questions.items()},
+            'broadcasts': self._broadcasts,
+            'dialogs': self._dialogs,
+            'deferred': self._deferred,
+            'queues': {queue: list(items) for queue, items in self._queues.items() if items},
+            'processing': [[queue, consumer, items] for (queue, consumer), items in self._processing.items() if items],
+            'dead_letters': list(self._dead_letters),
+            'chatrooms': self._chatrooms,
+            'feed': self._feed,
+            'feed_sequence': self._feed_sequence,
+        }
+        data = msgpack.packb(state, use_bin_type=True, default=default_handler)
+
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self._path)
+
+    def _load(self):
+        """Loads snapshot and replays the newer journals, returns generation of the last one"""
+        generation = 0
+        if os.path.exists(self._path):
+            generation = self._load_snapshot()
+
+        replayed = 0
+        journals = self._journal_generations()
+        for journal in journals:
+            if journal < generation:
+                # already included in the snapshot, compaction was interrupted before removing it
+                os.remove(self._journal_path(journal))
+            else:
+                replayed += self._replay_journal(journal)
+        log.info('Loaded storage with %d questions, replayed %d changes' % (self.count_questions(), replayed))
+        return max(journals + [generation])
+
+    def _load_snapshot(self):
+        with open(self._path, 'rb') as f:
+            state = msgpack.unpackb(f.read(), encoding='utf-8')
+        # snapshots of version 1 were written without journal
+        if state.get('version') not in (1, self.SNAPSHOT_VERSION):
+            raise ValueError('Unsupported snapshot version %s' % state.get('version'))
+
+        self._apply_questions([(jid, question_id, decode_question(record))
+                               for jid, questions in state['questions'].items()
+                               for question_id, record in questions.items()])
+        self._broadcasts = state['broadcasts']
+        self._dialogs = state['dialogs']
+        self._deferred = state['deferred']
+        for queue, items in state['queues'].items():
+            self._queues[queue].extend(items)
+        for queue, consumer, items in state['processing']:
+            self._processing[(queue, consumer)] = items
+        self._dead_letters.extend(state['dead_letters'])
+        self._chatrooms = state['chatrooms']
+        # snapshots written before the feed was added don't contain it
+        self._feed = state.get('feed', [])
+        self._feed_sequence = state.get('feed_sequence', 0)
+        return state.get('generation', 0)
+
+    def _replay_journal(self, generation):
+        """Applies changes recorded in the journal, returns their number"""
+        count = 0
+        with open(self._journal_path(generation), 'rb') as f:
+            try:
+                # incomplete record at the end of the journal written during crash is skipped by the unpacker
+                for operation, args in msgpack.Unpacker(f, encoding='utf-8'):
+                    if operation == 'questions':
+                        args = [[(jid, question_id, decode_question(record)) for jid, question_id, record in args[0]]]
+                    getattr(self, '_apply_' + operation)(*args)
+                    count += 1
+            except Exception:
+                log.exception('Corrupted storage journal %s, ignoring changes after %d records'
+                              % (self._journal_path(generation), count))
+        return count
+
+    def _maintenance_loop(self):
+        purged = time.time()
+        while True:
+            gevent.sleep(self._sync_interval)
+            try:
+                if time.time() - purged > self.PURGE_INTERVAL:
+                    self._purge_expired()
+                    purged = time.time()
+                if self._path is None:
+                    continue
+
+                self._sync_journal()
+                if self._compaction is not None:
+                    pid, status = os.waitpid(self._compaction[0], os.WNOHANG)
+                    if pid:
+                        self._finish_compaction(status)
+                elif self._journal_size > self._compact_size:
+                    self._compact()
+            except Exception:
+                log.exception('Error while writing storage journal')
@@ -0,0 +1,170 @@
+"""
+Lightweight instrumentation exposed in Prometheus text format.
+
+Metrics are registered in the process-wide REGISTRY using the `counter`, `gauge` and `histogram` functions.
+"""
+import time
+from functools import wraps
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+
+    def samples(self):
+        """Returns list of (name, label_key, value) tuples"""
+        return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        for name, key, value in self.samples():
+            lines.append('%s%s %s' % (name, _format_labels(key), repr(float(value))))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge set directly or computed by `callback` on collection.
+
+    Value returned by the callback is reused for `cache_time` seconds.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, callback=None, cache_time=0):
+        super(Gauge, self).__init__(name, documentation)
+        self._callback = callback
+        self._cache_time = cache_time
+        self._collected = 0
+
+    def set_callback(self, callback, cache_time=0):
+        self._callback = callback
+        self._cache_time = cache_time
+
+    def set(self, value, **labels):
+        self._values[_label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self._callback is not None and self._collected + self._cache_time <= time.time():
+            self._values = {(): self._callback()}
+            self._collected = time.time()
+        return super(Gauge, self).samples()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation)
+        self._buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        try:
+            counts, total = self._values[key]
+        except KeyError:
+            counts, total = [0] * len(self._buckets), [0.0, 0]
+
+        for i, bound in enumerate(self._buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+
+        total[0] += value
+        total[1] += 1
+        self._values[key] = (counts, total)
+
+    def time(self, **labels):
+        """Decorator measuring duration of the function call"""
+        def _decorator(func):
+            @wraps(func)
+            def _wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.time() - start, **labels)
+            return _wrapper
+        return _decorator
+
+    def samples(self):
+        output = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                output.append((self.name + '_bucket', key + (('le', repr(float(bound))),), cumulative))
+            output.append((self.name + '_bucket', key + (('le', '+Inf'),), total[1]))
+            output.append((self.name + '_sum', key, total[0]))
+            output.append((self.name + '_count', key, total[1]))
+        return output
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation):
+    return REGISTRY.register(Counter(name, documentation))
+
+
+def gauge(name, documentation, callback=None, cache_time=0):
+    return REGISTRY.register(Gauge(name, documentation, callback, cache_time))
+
+
+def histogram(name, documentation, buckets=Histogram.DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, buckets))
+
+
+def instrument_methods(histogram, label='operation'):
+    """Class decorator measuring duration of all public methods using `histogram` labeled by method name"""
+    def _decorator(cls):
+        for name, value in cls.__dict__.items():
+            if not name.startswith('_') and callable(value):
+                setattr(cls, name, histogram.time(**{label: name})(value))
+        return cls
+    return _decorator
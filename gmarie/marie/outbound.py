@@ -0,0 +1,113 @@
+import collections
+import gevent
+from gevent import Greenlet
+from gevent.event import Event
+from marie.utils import TokenBucket
+from marie import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+QUEUED_STANZAS = metrics.gauge('marie_outbound_queued_stanzas', 'Number of stanzas waiting to be sent')
+QUEUED_RECIPIENTS = metrics.gauge('marie_outbound_queued_recipients', 'Number of recipients with queued stanzas')
+PENDING_AUTHORIZATIONS = metrics.gauge('marie_pending_authorizations', 'Number of users waiting for authorization')
+SENT_STANZAS = metrics.counter('marie_outbound_sent_stanzas_total', 'Number of stanzas sent by outbound scheduler')
+
+
+class OutboundScheduler(Greenlet):
+    """
+    Sends outgoing stanzas within the server rate limits.
+
+    Stanzas are queued per recipient (FIFO) and recipients are served in round-robin order, so a burst of messages
+    to one user doesn't delay the others. Sending is limited by a global token bucket of `rate` stanzas per second
+    with bursts up to `burst` stanzas.
+
+    Subscription handshakes are processed asynchronously in batches of up to `auth_batch_size` users by calling
+    `authorize(jids)`, presences sent by the callback should be preceded by `acquire()`.
+    """
+    def __init__(self, authorize, rate=20, burst=50, auth_batch_size=50):
+        Greenlet.__init__(self)
+        self._authorize = authorize
+        self._bucket = TokenBucket(rate, burst)
+        self._auth_batch_size = auth_batch_size
+
+        self._queues = {}
+        self._ready = collections.deque()  # recipients with queued stanzas in round-robin order
+        self._wakeup = Event()
+        self._pending_auth = collections.OrderedDict()
+        self._auth_wakeup = Event()
+        self._auth_worker = None
+
+    def send(self, to, stanza):
+        """Queues stanza for sending, doesn't block"""
+        try:
+            self._queues[to].append(stanza)
+        except KeyError:
+            self._queues[to] = collections.deque([stanza])
+            self._ready.append(to)
+            QUEUED_RECIPIENTS.inc()
+        QUEUED_STANZAS.inc()
+        self._wakeup.set()
+
+    def authorize(self, jid):
+        """Queues subscription handshake with the user, doesn't block"""
+        if jid not in self._pending_auth:
+            self._pending_auth[jid] = True
+            PENDING_AUTHORIZATIONS.inc()
+            self._auth_wakeup.set()
+
+    def acquire(self):
+        """Waits until the stanza can be sent within the rate limit"""
+        while not self._bucket.consume():
+            gevent.sleep(self._bucket.delay())
+
+    def stop(self):
+        if self._auth_worker is not None:
+            self._auth_worker.kill()
+        self.kill()
+
+    def _next_stanza(self):
+        to = self._ready.popleft()
+        queue = self._queues[to]
+        stanza = queue.popleft()
+        if queue:
+            self._ready.append(to)
+        else:
+            del self._queues[to]
+            QUEUED_RECIPIENTS.dec()
+        QUEUED_STANZAS.dec()
+        return stanza
+
+    def _authorization_loop(self):
+        while True:
+            if not self._pending_auth:
+                self._auth_wakeup.clear()
+                self._auth_wakeup.wait()
+                continue
+
+            batch = []
+            while self._pending_auth and len(batch) < self._auth_batch_size:
+                batch.append(self._pending_auth.popitem(last=False)[0])
+            PENDING_AUTHORIZATIONS.dec(len(batch))
+
+            try:
+                self._authorize(batch)
+            except Exception:
+                log.exception('Error while authorizing users')
+
+    def _run(self):
+        self._auth_worker = gevent.spawn(self._authorization_loop)
+
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                self._wakeup.wait()
+                continue
+
+            stanza = self._next_stanza()
+            self.acquire()
+            try:
+                stanza.send()
+                SENT_STANZAS.inc()
+            except Exception:
+                log.exception('Error while sending stanza')
@@ -0,0 +1,207 @@
+import collections
+import time
+from urlparse import urlparse
+import gevent
+from gevent.pool import Pool
+from gevent.queue import Queue
+import requests
+from requests.adapters import HTTPAdapter
+from marie import metrics
+
+POSTBACK_SECONDS = metrics.histogram('marie_postback_request_seconds', 'Duration of postback HTTP requests')
+POSTBACKS = metrics.counter('marie_postbacks_total', 'Number of processed postbacks')
+POSTBACK_RETRIES = metrics.counter('marie_postback_retries_total', 'Number of retried postback requests')
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class PostbackDispatcher(object):
+    """
+    Delivers postbacks (HTTP POST requests) using bounded pool of workers.
+
+    Keep-alive session is kept for every target host and number of concurrent deliveries to the same host is limited,
+    postbacks to a host at the limit are parked without occupying a worker, so a slow host doesn't starve the others.
+    Failed requests are retried with exponential backoff, postbacks which could not be delivered are saved
+    to the dead-letter list in storage (if available). Postbacks submitted with the same `ordering_key` are
+    delivered one at a time in the order of submission, the next one is sent when the previous one is delivered
+    or dead-lettered.
+
+    If `durable` is set, postbacks are written to the queue in storage first and consumed in batches, postbacks
+    fetched but not acknowledged before restart are delivered again after restart of the same `consumer`.
+    """
+    def __init__(self, storage=None, workers=20, per_host=4, retries=3, backoff=0.5, timeout=10, durable=True,
+                 consumer='default', batch_size=100):
+        self._storage = storage
+        self._durable = durable and storage is not None
+        self._consumer = consumer
+        self._batch_size = batch_size
+        self._workers = workers
+        self._per_host = per_host
+        self._retries = retries
+        self._backoff = backoff
+        self._timeout = timeout
+
+        self._queue = Queue(maxsize=batch_size if self._durable else None)
+        self._acks = []
+        self._pool = Pool(workers + 1)
+        self._sessions = {}
+        self._host_active = collections.defaultdict(int)  # host -> number of postbacks being delivered
+        self._host_waiting = collections.defaultdict(collections.deque)  # host -> postbacks waiting for the host
+        self._ordered = {}  # ordering key -> postbacks waiting for the one being delivered
+        self._ready = collections.deque()  # released postbacks which can be delivered
+
+    def start(self):
+        if self._durable:
+            self._storage.restore_postbacks(self._consumer)
+            self._pool.spawn(self._feeder)
+
+        while not self._pool.full():
+            self._pool.spawn(self._worker)
+
+    def stop(self):
+        self._pool.kill()
+        self._flush_acks()
+
+    def submit(self, url, data, headers=None, ordering_key=None):
+        """Schedules postback delivery"""
+        self.submit_many([(url, data, headers)], ordering_key)
+
+    def submit_many(self, postbacks, ordering_key=None):
+        """Schedules delivery of multiple postbacks given as (url, data, headers) tuples, enqueued at once"""
+        jobs = [{'url': url, 'data': data, 'headers': headers or {}} for url, data, headers in postbacks]
+        if ordering_key is not None:
+            for job in jobs:
+                job['ordering_key'] = ordering_key
+
+        if self._durable:
+            self._storage.enqueue_postbacks(jobs)
+        else:
+            for job in jobs:
+                self._queue.put(job)
+
+    def _flush_acks(self):
+        if self._acks:
+            acks, self._acks = self._acks, []
+            self._storage.ack_postbacks(self._consumer, acks)
+
+    def _feeder(self):
+        """Moves postbacks from storage queue to workers"""
+        while True:
+            try:
+                self._flush_acks()
+                for raw, job in self._storage.fetch_postbacks(self._consumer, self._batch_size, timeout=1):
+                    job['_raw'] = raw
+                    self._queue.put(job)  # blocks while workers are busy
+            except Exception:
+                log.exception('Error while fetching postbacks')
+                gevent.sleep(1)
+
+    def _session(self, host):
+        try:
+            return self._sessions[host]
+        except KeyError:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._sessions[host] = session
+            return session
+
+    def _post(self, host, job):
+        start = time.time()
+        try:
+            r = self._session(host).post(job['url'], data=job['data'], headers=job['headers'], timeout=self._timeout)
+        finally:
+            POSTBACK_SECONDS.observe(time.time() - start)
+        r.raise_for_status()
+
+    def _deliver(self, job):
+        host = urlparse(job['url']).netloc
+
+        for attempt in range(self._retries + 1):
+            try:
+                self._post(host, job)
+                return POSTBACKS.inc(result='delivered')
+            except requests.HTTPError as e:
+                # client errors are not going to be fixed by retrying
+                if e.response is not None and e.response.status_code < 500:
+                    return self._dead_letter(job, e)
+                error = e
+            except requests.RequestException as e:
+                error = e
+
+            if attempt < self._retries:
+                POSTBACK_RETRIES.inc()
+                gevent.sleep(self._backoff * 2 ** attempt)
+
+        self._dead_letter(job, error)
+
+    def _dead_letter(self, job, error):
+        POSTBACKS.inc(result='failed')
+        log.warning('Postback to %s failed: %s' % (job['url'], error))
+        if self._storage is not None:
+            job = dict(job, error=str(error))
+            self._storage.add_dead_letter(job)
+
+    def _process(self, job):
+        raw = job.pop('_raw', None)
+        try:
+            self._deliver(job)
+        except Exception:
+            log.exception('Error while delivering postback to %s' % job['url'])
+
+        # delivered or dead-lettered, acknowledged in the next batch
+        if raw is not None:
+            self._acks.append(raw)
+
+    def _acquire_host(self, task):
+        """Returns True if the postback can be delivered now, otherwise it waits until the host is released"""
+        host = task[2]
+        if self._host_active[host] >= self._per_host:
+            self._host_waiting[host].append(task)
+            return False
+        self._host_active[host] += 1
+        return True
+
+    def _schedule(self, job):
+        """Returns (job, ordering key, host) task if the postback can be delivered now, otherwise parks it"""
+        key = job.pop('ordering_key', None)
+        task = (job, key, urlparse(job['url']).netloc)
+        if key is not None:
+            # delivered when the previous postback with the same key is released
+            if key in self._ordered:
+                self._ordered[key].append(task)
+                return None
+            self._ordered[key] = collections.deque()
+        return task if self._acquire_host(task) else None
+
+    def _release(self, task):
+        """Releases host and ordering key of processed postback, the postbacks waiting for them are made ready"""
+        _, key, host = task
+        self._host_active[host] -= 1
+
+        # the postbacks waiting for the host go first, so they are not starved by the ordered ones
+        waiting = self._host_waiting.get(host)
+        if waiting:
+            self._host_active[host] += 1
+            self._ready.append(waiting.popleft())
+            if not waiting:
+                del self._host_waiting[host]
+
+        if key is not None:
+            ordered = self._ordered[key]
+            if not ordered:
+                del self._ordered[key]
+                return
+            task = ordered.popleft()
+            if self._acquire_host(task):
+                self._ready.append(task)
+
+    def _worker(self):
+        while True:
+            # released postbacks are picked up by the workers which released them
+            task = self._ready.popleft() if self._ready else self._schedule(self._queue.get())
+            if task is not None:
+                self._process(task[0])
+                self._release(task)
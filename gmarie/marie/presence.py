@@ -0,0 +1,86 @@
+import time
+
+
+class PresenceRecord(object):
+    """Last known status of a user and the time it was received"""
+    __slots__ = ('status', 'updated')
+
+    def __init__(self, status, updated):
+        self.status = status
+        self.updated = updated
+
+
+class PresenceIndex(object):
+    """
+    Compact store of user statuses.
+
+    Keeps single record with interned status per bare JID and reverse index of JIDs by status, so the users
+    in some status can be found without going through the whole roster.
+    """
+    def __init__(self):
+        self._records = {}
+        self._by_status = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, jid):
+        return jid in self._records
+
+    def update(self, jid, status, timestamp=None):
+        status = intern(str(status))
+        updated = time.time() if timestamp is None else timestamp
+
+        record = self._records.get(jid)
+        if record is None:
+            self._records[jid] = PresenceRecord(status, updated)
+        else:
+            if record.status != status:
+                self._discard(jid, record.status)
+            record.status = status
+            record.updated = updated
+        self._by_status.setdefault(status, set()).add(jid)
+
+    def remove(self, jid):
+        record = self._records.pop(jid, None)
+        if record is not None:
+            self._discard(jid, record.status)
+
+    def _discard(self, jid, status):
+        jids = self._by_status[status]
+        jids.discard(jid)
+        if not jids:
+            del self._by_status[status]
+
+    def clear(self):
+        self._records.clear()
+        self._by_status.clear()
+
+    def get(self, jid):
+        """Returns PresenceRecord of the user or None if no presence was received from the user"""
+        return self._records.get(jid)
+
+    def get_status(self, jid):
+        try:
+            return self._records[jid].status
+        except KeyError:
+            return None
+
+    def with_status(self, *statuses):
+        """Returns set of JIDs in any of given statuses"""
+        if len(statuses) == 1:
+            return set(self._by_status.get(statuses[0], ()))
+
+        jids = set()
+        for status in statuses:
+            jids.update(self._by_status.get(status, ()))
+        return jids
+
+    def count(self, status):
+        return len(self._by_status.get(status, ()))
+
+    def filter(self, jids, statuses):
+        """Returns JIDs (keeping the order) of users in any of given statuses"""
+        statuses = frozenset(statuses)
+        records = self._records
+        return [jid for jid in jids if jid in records and records[jid].status in statuses]
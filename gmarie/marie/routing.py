@@ -0,0 +1,128 @@
+import re
+
+
+class PrefixTree(object):
+    """
+    Radix tree of strings supporting lookup by unique prefix.
+
+    Edges are labeled by string fragments, every node keeps number of values stored below it.
+    """
+    def __init__(self):
+        self._root = [{}, None, 0]  # children (first char -> (label, node)), value, count
+
+    def insert(self, key, value):
+        node = self._root
+        node[2] += 1
+        while key:
+            try:
+                label, child = node[0][key[0]]
+            except KeyError:
+                node[0][key[0]] = (key, [{}, value, 1])
+                return
+
+            common = 0
+            while common < min(len(label), len(key)) and label[common] == key[common]:
+                common += 1
+
+            if common < len(label):
+                # split the edge
+                middle = [{label[common]: (label[common:], child)}, None, child[2]]
+                node[0][key[0]] = (label[:common], middle)
+                child = middle
+
+            child[2] += 1
+            node = child
+            key = key[common:]
+        node[1] = value
+
+    def find(self, prefix):
+        """Returns value stored under `prefix` if it is the exact key or it is unique prefix of a key"""
+        node = self._root
+        exact = True
+        while prefix:
+            try:
+                label, node = node[0][prefix[0]]
+            except KeyError:
+                return None
+            if not label.startswith(prefix[:len(label)]):
+                return None
+            exact = len(prefix) >= len(label)
+            prefix = prefix[len(label):]
+
+        if exact and node[1] is not None:
+            return node[1]
+        if node[2] != 1:
+            return None
+
+        # descend to the only value
+        while node[1] is None:
+            node = node[0].values()[0][1]
+        return node[1]
+
+
+class QuestionIndex(object):
+    """
+    Index of pending questions of single user used to route answers without the multiple question dialog.
+
+    Answer is resolved by:
+    1. XMPP thread id of the message
+    2. question id (or its unique prefix) at the beginning of the message in the form of `#question_id answer`
+    3. keywords declared by the question (`keywords` argument, list or comma separated string), the message
+       has to contain keywords of exactly one question
+    """
+    ID_PREFIX = '#'
+    _words = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self, questions):
+        self.signature = self.get_signature(questions)
+        # the furthest deadline, None if some question never expires
+        deadlines = [question.get('expires') for question in questions.values()]
+        self.expires = max(deadlines) if deadlines and None not in deadlines else None
+        self._threads = {}
+        self._ids = PrefixTree()
+        self._keywords = {}
+
+        for question_id, question in questions.items():
+            self._ids.insert(unicode(question_id), question_id)
+
+            if question.get('thread'):
+                self._threads[question['thread']] = question_id
+
+            keywords = question.get('keywords') or []
+            if isinstance(keywords, basestring):
+                keywords = keywords.split(',')
+            for keyword in keywords:
+                self._keywords.setdefault(keyword.strip().lower(), set()).add(question_id)
+
+        # multiple question dialog, questions are ordered by the time they were sent
+        ordered = sorted(questions.items(), key=lambda item: (item[1]['sent'], item[0]))
+        self.mapping = {unicode(number): question_id for number, (question_id, _) in enumerate(ordered, 1)}
+        self.menu = u''.join(u"\n[%d] %s [%s]" % (number, question['text'], question_id)
+                             for number, (question_id, question) in enumerate(ordered, 1))
+
+    @staticmethod
+    def get_signature(questions):
+        return frozenset((question_id, question['sent']) for question_id, question in questions.items())
+
+    def resolve(self, msg):
+        """Returns tuple of question id and answer text, question id is None if the answer can't be resolved"""
+        body = msg['body']
+
+        question_id = self._threads.get(msg['thread'])
+        if question_id is not None:
+            return question_id, body
+
+        if body.startswith(self.ID_PREFIX):
+            prefix, _, text = body[len(self.ID_PREFIX):].partition(' ')
+            question_id = self._ids.find(prefix)
+            if question_id is not None and text.strip():
+                return question_id, text.strip()
+
+        if self._keywords:
+            matched = set()
+            for word in self._words.findall(body.lower()):
+                matched.update(self._keywords.get(word, ()))
+            if len(matched) == 1:
+                return matched.pop(), body
+
+        return None, body
@@ -0,0 +1,238 @@
+import time
+from datetime import timedelta
+
+
+def default_handler(obj):
+    """Serialization handler with datetime and timedelta (converted to seconds) addon"""
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    elif isinstance(obj, timedelta):
+        return obj.total_seconds()
+    else:
+        raise TypeError('Object of type %s with value of %s is not JSON serializable' % (type(obj), repr(obj)))
+
+
+def to_timestamp(value):
+    """Converts naive local datetime to UNIX timestamp"""
+    return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+
+class Storage(object):
+    """
+    Interface of storage backends.
+
+    Stores pending questions (hashes of questions by question id for every JID) with their deadlines, state
+    of the multiple question dialog, deferred messages, reliable queues used for postbacks and cluster
+    communication and monitored chatrooms. Question ids and JIDs are returned as byte strings.
+    """
+    DEAD_LETTERS_LIMIT = 10000
+    DIALOG_TTL = 86400  # lifetime of multiple question dialog state when the questions have no deadline
+    QUESTION_GRACE = 3600  # questions are kept for this many seconds after the furthest deadline
+    POSTBACK_QUEUE = 'postbacks'
+    FEED_LIMIT = 100000  # number of the newest feed entries kept
+
+    def clear_database(self):
+        raise NotImplementedError
+
+    def close(self):
+        """Called on shutdown after all workers and listeners are stopped"""
+        pass
+
+    # questions
+
+    def get_questions(self, jid):
+        """Returns dict of all questions of the JID by question id"""
+        raise NotImplementedError
+
+    def set_question(self, jid, question_id, data):
+        """
+        Adds new question to database.
+
+        Questions with `expires` set are also scheduled for expiration (see `get_due_expiries`).
+        """
+        self.set_questions([(jid, question_id, data)])
+
+    def set_questions(self, questions):
+        """Adds multiple questions given as (jid, question_id, data) tuples"""
+        raise NotImplementedError
+
+    def add_broadcast(self, question_id, questions):
+        """Adds question sent to multiple users, takes list of (jid, data) tuples"""
+        raise NotImplementedError
+
+    def claim_broadcast(self, question_id):
+        """
+        Atomically removes broadcast and returns list of its recipients.
+
+        Returns None if the broadcast was already claimed (i.e. answered by another recipient).
+        """
+        raise NotImplementedError
+
+    def delete_broadcast_questions(self, question_id, recipients):
+        raise NotImplementedError
+
+    def delete_questions(self, jid, *question_ids):
+        raise NotImplementedError
+
+    def pop_question(self, jid, question_id):
+        """
+        Atomically loads and deletes the question.
+
+        Returns None if the question was already removed (e.g. expired by another process), so the caller
+        can use the result as a claim.
+        """
+        return self.pop_questions([(jid, question_id)])[0]
+
+    def pop_questions(self, questions):
+        """
+        Atomically loads and deletes multiple questions.
+
+        Takes list of (jid, question_id) tuples and returns list of questions in the same order, None is returned
+        for questions that no longer exist.
+        """
+        raise NotImplementedError
+
+    def get_due_expiries(self, until, limit):
+        """
+        Returns list of (jid, question_id) tuples of questions which expire before `until` (UNIX timestamp).
+
+        At most `limit` entries ordered by deadline are returned.
+        """
+        raise NotImplementedError
+
+    def next_expiry(self):
+        """Returns UNIX timestamp of the nearest question deadline or None if there is no such question"""
+        raise NotImplementedError
+
+    def count_questions(self):
+        raise NotImplementedError
+
+    def migrate_questions(self):
+        """Rewrites questions stored in legacy format, returns number of migrated questions"""
+        return 0
+
+    # maintenance, backends which can leave orphaned entries behind override these (see StorageSweeper)
+
+    def sweep_expiries(self, cursor, count):
+        """Returns tuple of the next cursor (0 when finished) and number of removed entries"""
+        return 0, 0
+
+    def sweep_broadcasts(self, cursor, count):
+        return 0, 0
+
+    def sweep_question_keys(self, cursor, count):
+        return 0, 0
+
+    def sweep_legacy_hashes(self, cursor, count):
+        return 0, 0
+
+    def sweep_question_count(self, cursor, count):
+        return 0, 0
+
+    # multiple question dialog
+
+    def load_answer_and_mapping(self, jid):
+        """Returns tuple of saved answer text (or None) and questions mapping (number: question_id)"""
+        raise NotImplementedError
+
+    def save_answer_and_mapping(self, jid, mapping, answer=None, expires=None):
+        """
+        Saves questions mapping and optionally answer text.
+
+        The dialog state is removed question grace seconds (DIALOG_TTL if questions are kept without limit) after
+        `expires` (the furthest deadline of the questions) or after DIALOG_TTL seconds if not given.
+        """
+        raise NotImplementedError
+
+    def delete_answer_and_mapping(self, jid):
+        raise NotImplementedError
+
+    # deferred messages
+
+    def defer_messages(self, jid, items, ttl, max_length):
+        """
+        Parks messages for user until the user becomes available.
+
+        Only last `max_length` messages are kept, the whole queue is removed after `ttl` seconds without new messages.
+        """
+        raise NotImplementedError
+
+    def pop_deferred_messages(self, jid):
+        """Atomically loads and removes all messages deferred for user, oldest first"""
+        raise NotImplementedError
+
+    # reliable queues
+
+    def push_queue(self, queue, items):
+        raise NotImplementedError
+
+    def fetch_queue(self, queue, consumer, count, timeout=0):
+        """
+        Moves up to `count` oldest items from the queue to the processing list of the consumer.
+
+        Blocks for `timeout` seconds (forever if 0) when the queue is empty. Returns list of (raw, item) tuples,
+        raw value has to be passed to ack_queue after the item is processed.
+        """
+        raise NotImplementedError
+
+    def ack_queue(self, queue, consumer, raw_items):
+        """Removes processed items from the processing list"""
+        raise NotImplementedError
+
+    def restore_queue(self, queue, consumer):
+        """Returns unacknowledged items of the consumer to the front of the queue (e.g. after restart)"""
+        raise NotImplementedError
+
+    def enqueue_postbacks(self, jobs):
+        """Appends postbacks to the delivery queue"""
+        self.push_queue(self.POSTBACK_QUEUE, jobs)
+
+    def fetch_postbacks(self, consumer, count, timeout=0):
+        return self.fetch_queue(self.POSTBACK_QUEUE, consumer, count, timeout)
+
+    def ack_postbacks(self, consumer, raw_jobs):
+        self.ack_queue(self.POSTBACK_QUEUE, consumer, raw_jobs)
+
+    def restore_postbacks(self, consumer):
+        self.restore_queue(self.POSTBACK_QUEUE, consumer)
+
+    def add_dead_letter(self, data):
+        """Saves undelivered postback, only last DEAD_LETTERS_LIMIT postbacks are kept"""
+        raise NotImplementedError
+
+    def get_dead_letters(self, count=100):
+        """Loads last `count` undelivered postbacks"""
+        raise NotImplementedError
+
+    # answer feed
+
+    def append_feed(self, entries):
+        """
+        Appends entries to the append-only feed, every entry gets a cursor (sequence number).
+
+        Only last FEED_LIMIT entries are kept. Returns cursor of the last appended entry.
+        """
+        raise NotImplementedError
+
+    def read_feed(self, since, limit):
+        """Returns list of up to `limit` (cursor, entry) tuples of entries appended after cursor `since`"""
+        raise NotImplementedError
+
+    # monitored chatrooms
+
+    def get_chatrooms(self):
+        raise NotImplementedError
+
+    def add_chatroom(self, room, nick, password, postback_url, **options):
+        """Saves monitored chatroom, returns its data"""
+        raise NotImplementedError
+
+    def delete_chatroom(self, room):
+        raise NotImplementedError
+
+    def publish_chatrooms_changed(self):
+        raise NotImplementedError
+
+    def subscribe_chatrooms_changed(self):
+        """Returns subscription to chatroom change notifications, its `listen()` yields pub/sub messages"""
+        raise NotImplementedError
@@ -0,0 +1,55 @@
+import gevent
+from gevent import Greenlet
+from marie import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+SWEPT_ENTRIES = metrics.counter('marie_swept_entries_total', 'Number of orphaned storage entries reclaimed')
+
+
+class StorageSweeper(Greenlet):
+    """
+    Reclaims orphaned entries in storage.
+
+    Every `interval` seconds the storage is scanned incrementally in batches of `batch_size` entries with `pause`
+    seconds between the batches, so the sweep never blocks Redis for long.
+    """
+    def __init__(self, storage, interval=3600, batch_size=100, pause=0.1):
+        Greenlet.__init__(self)
+        self._storage = storage
+        self._interval = interval
+        self._batch_size = batch_size
+        self._pause = pause
+
+    def _phases(self):
+        return [
+            ('expiries', self._storage.sweep_expiries),
+            ('broadcasts', self._storage.sweep_broadcasts),
+            ('questions', self._storage.sweep_question_keys),
+            ('legacy', self._storage.sweep_legacy_hashes),
+            ('count', self._storage.sweep_question_count),
+        ]
+
+    def sweep(self):
+        """Runs single sweep over the whole storage, returns number of reclaimed entries"""
+        total = 0
+        for name, sweep_batch in self._phases():
+            cursor = 0
+            while True:
+                cursor, count = sweep_batch(cursor, self._batch_size)
+                if count:
+                    SWEPT_ENTRIES.inc(count, kind=name)
+                    total += count
+                if not int(cursor):
+                    break
+                gevent.sleep(self._pause)
+        return total
+
+    def _run(self):
+        while True:
+            gevent.sleep(self._interval)
+            try:
+                log.info('Storage sweep reclaimed %d entries' % self.sweep())
+            except Exception:
+                log.exception('Error while sweeping storage')
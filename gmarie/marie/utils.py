@@ -1,22 +1,67 @@
+import collections
 import inspect
-from gevent import Greenlet
-import requests
+import time
 
+# resolved bot command, `handler` is name of the method in class and bound method in instance dispatch table
+BotCommand = collections.namedtuple('BotCommand', 'name handler args_parser allowed_groups blocking timeout')
 
-def do_post_requests(postback_url, data, **kwargs):
-    g = Greenlet(requests.post, postback_url, data=data, **kwargs)
-    g.start()
+# roster groups allowed to run commands with given min_privilege, None means everybody
+PRIVILEGE_GROUPS = {
+    'user': None,
+    'manager': frozenset(['admin', 'manager']),
+    'admin': frozenset(['admin']),
+}
 
 
 class GatherBotCommands(type):
     """Goes through all class methods and collects bot commands into cls._bot_commands"""
 
     def __new__(mcs, future_class_name, future_class_parents, future_class_attr):
-        cls = type(future_class_name, future_class_parents, future_class_attr)
+        cls = super(GatherBotCommands, mcs).__new__(mcs, future_class_name, future_class_parents, future_class_attr)
         cls._bot_commands = {}
 
         for name, method in inspect.getmembers(cls, predicate=inspect.ismethod):
             if hasattr(method, '_bot_command'):
-                cls._bot_commands[method._bot_name] = name
+                cls._bot_commands[method._bot_name] = BotCommand(
+                    name=method._bot_name,
+                    handler=name,
+                    args_parser=method._bot_argsparser,
+                    allowed_groups=PRIVILEGE_GROUPS[method._bot_min_privilege],
+                    blocking=not method._bot_async,
+                    timeout=method._bot_timeout
+                )
 
-        return cls
\ No newline at end of file
+        return cls
+
+
+class TokenBucket(object):
+    """Token bucket rate limiter refilled by `rate` tokens per second up to `capacity` tokens"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def full(self):
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def consume(self, tokens=1):
+        """Takes tokens from the bucket, returns False if there is not enough tokens"""
+        self._refill()
+        if self._tokens < tokens:
+            return False
+        self._tokens -= tokens
+        return True
+
+    def delay(self, tokens=1):
+        """Returns number of seconds until `tokens` tokens are available"""
+        self._refill()
+        return max(0.0, (tokens - self._tokens) / float(self.rate))
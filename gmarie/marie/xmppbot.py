@@ -6,6 +6,7 @@ import logging
 log = logging.getLogger(__name__)
 
 import gevent
+import time
 import subprocess
 from gevent import Greenlet
 from functools import wraps
@@ -14,15 +15,23 @@ from sleekxmpp import ClientXMPP
 from sleekxmpp.exceptions import IqError, IqTimeout
 from args_parser import SepArgsParser
 from marie.utils import GatherBotCommands
+from marie.commands import CommandExecutor, CommandTimeout
+from marie.outbound import OutboundScheduler
+from marie.presence import PresenceIndex
+from marie import metrics
 
+COMMAND_SECONDS = metrics.histogram('marie_command_seconds', 'Duration of bot command execution')
+COMMANDS = metrics.counter('marie_commands_total', 'Number of processed bot commands')
 
-def bot_command(f=None, name=None, min_privilege='user', block=False, args_parser=SepArgsParser()):
+
+def bot_command(f=None, name=None, min_privilege='user', block=False, args_parser=SepArgsParser(), timeout=None):
     """
     Bot command decorator.
 
     name is the name of the bot command that is going to be used
     Never use `f` argument directly, used only for @bot_command decorator
     If async is set, the command is run in separated Greenlet
+    timeout is the maximum number of seconds the command can run
     """
     def _decorator(func):
         bot_name = func.__name__ if name is None else name
@@ -31,6 +40,7 @@ def bot_command(f=None, name=None, min_privilege='user', block=False, args_parse
         setattr(func, '_bot_async', not block)
         setattr(func, '_bot_name', bot_name)
         setattr(func, '_bot_min_privilege', min_privilege)
+        setattr(func, '_bot_timeout', timeout)
 
         def _wrapper(*args, **kwargs):
             return func(*args, **kwargs)
@@ -45,15 +55,24 @@ def bot_command(f=None, name=None, min_privilege='user', block=False, args_parse
 class XMPPBot(ClientXMPP, Greenlet):
     __metaclass__ = GatherBotCommands
 
-    def __init__(self, jid, password, command_prefix='', chat_command_prefix='!'):
+    def __init__(self, jid, password, command_prefix='', chat_command_prefix='!', command_executor=None,
+                 send_rate=20, send_burst=50):
         ClientXMPP.__init__(self, jid, password)
         Greenlet.__init__(self)
 
+        self._command_executor = CommandExecutor() if command_executor is None else command_executor
+        self._outbound = OutboundScheduler(self._authorize_users, send_rate, send_burst)
+
+        # dispatch table of bot commands with bound handlers, built once per instance
+        self._command_table = {name: command._replace(handler=getattr(self, command.handler))
+                               for name, command in self._bot_commands.items()}
+        self._user_groups_cache = {}
+
         self._cmd_prefix = command_prefix
         self._chat_cmd_prefix = chat_command_prefix
         self._authorization_sent = set()  # set of jids for which the auth request was already sent in this session
         self._active_nicknames = set()
-        self.user_status_presence = {}  # dict of last status presence received from user
+        self.presence = PresenceIndex()  # last status received from users
 
         # automatically authorize user after sending subscription request
         self.auto_authorize = True
@@ -62,6 +81,8 @@ class XMPPBot(ClientXMPP, Greenlet):
         self.add_event_handler('session_start', self._session_start)
         self.add_event_handler('message', self._message_received)
         self.add_event_handler('changed_status', self._user_status_changed)
+        self.add_event_handler('roster_update', self._roster_updated)
+        self.add_event_handler('changed_subscription', self._roster_updated)
 
         #self.add_event_handler("groupchat_message", self._message_received)
 
@@ -73,10 +94,14 @@ class XMPPBot(ClientXMPP, Greenlet):
     def leave_chat_room(self, room, nick):
         return self.plugin['xep_0045'].leaveMUC(room, nick)
 
-    def send_chat_message(self, to, text, authorize_user=True):
+    def send_chat_message(self, to, text, authorize_user=True, thread=None):
+        """Queues chat message for sending, messages are sent by the outbound scheduler within the rate limit"""
         if authorize_user:
-            self._authorize_user(to)  # make sure the subscription is already established
-        return self.send_message(to, mbody=text, mtype='chat')
+            self._outbound.authorize(to)  # make sure the subscription is established
+        msg = self.make_message(to, mbody=text, mtype='chat')
+        if thread is not None:
+            msg['thread'] = thread
+        self._outbound.send(to, msg)
 
     def get_user_status(self, jid):
         """
@@ -84,17 +109,35 @@ class XMPPBot(ClientXMPP, Greenlet):
 
         Doesn't issue server call
         """
-        try:
-            return self.user_status_presence[jid].get_type()
-        except KeyError:
-            pass
-
-        return None
+        return self.presence.get_status(jid)
 
     def get_user_groups(self, jid):
         return self.client_roster[jid]['groups']
 
+    def _cached_user_groups(self, jid):
+        """User roster groups cached until the next roster update"""
+        try:
+            return self._user_groups_cache[jid]
+        except KeyError:
+            try:
+                groups = frozenset(self.get_user_groups(jid))
+            except KeyError:  # user is not present in roster
+                groups = frozenset()
+            self._user_groups_cache[jid] = groups
+            return groups
+
+    def _roster_updated(self, event):
+        self._user_groups_cache.clear()
+
+    def get_group_members(self, group, statuses=None):
+        """Returns list of JIDs in roster group, only users in one of `statuses` are returned if specified"""
+        members = self.client_roster.groups().get(group, [])
+        if statuses is not None:
+            return self.presence.filter(members, statuses)
+        return members
+
     def _session_start(self, event):
+        self.presence.clear()  # statuses are received again after the initial presence
         self.send_presence()
         try:
             self.get_roster()
@@ -110,7 +153,7 @@ class XMPPBot(ClientXMPP, Greenlet):
         self._started = datetime.now()
 
     def _user_status_changed(self, presence):
-        self.user_status_presence[presence['from'].bare] = presence
+        self.presence.update(presence['from'].bare, presence.get_type())
 
     def _authorize_user(self, jid):
         """
@@ -119,89 +162,127 @@ class XMPPBot(ClientXMPP, Greenlet):
         If the authorization request was already sent, but not in actual session then the authorization request
         will be re-sent.
         """
-        try:
-            subscription = self.client_roster[jid]
-            if subscription['subscription'] != 'both':
-                # if the subscription is pending and the request wasn't sent in actual session
-                # then re-send the authorization request
-                if subscription['pending_out']:
-                    if jid not in self._authorization_sent:  # request wasn't sent in actual session
-                        self._rerequest_authorization(jid)
-
-                        # make sure that the authorization request is not sent more than once in current session
-                        self._authorization_sent.add(jid)
-                else:
-                    self.send_presence(pto=jid, ptype='subscribe')
-        except KeyError:  # user is not present in roster
+        self._authorize_users([jid])
+
+    def _authorize_users(self, jids):
+        """
+        Authorize multiple users at once, pending requests are re-sent with single delay for the whole batch.
+        """
+        subscribe = []
+        rerequest = []
+        for jid in jids:
+            try:
+                subscription = self.client_roster[jid]
+            except KeyError:  # user is not present in roster
+                subscribe.append(jid)
+                continue
+
+            if subscription['subscription'] == 'both':
+                continue
+            # if the subscription is pending and the request wasn't sent in actual session
+            # then re-send the authorization request
+            if subscription['pending_out']:
+                if jid not in self._authorization_sent:  # request wasn't sent in actual session
+                    rerequest.append(jid)
+
+                    # make sure that the authorization request is not sent more than once in current session
+                    self._authorization_sent.add(jid)
+            else:
+                subscribe.append(jid)
+
+        if rerequest:
+            self._rerequest_authorization(rerequest)
+        for jid in subscribe:
+            self._outbound.acquire()
             self.send_presence(pto=jid, ptype='subscribe')
 
-    def _rerequest_authorization(self, jid):
+    def _rerequest_authorization(self, jids):
         """
-        Re-send authorization request.
+        Re-send authorization request to list of users.
         """
-        self.send_presence(pto=jid, ptype='unsubscribe')
+        for jid in jids:
+            self._outbound.acquire()
+            self.send_presence(pto=jid, ptype='unsubscribe')
         gevent.sleep(0.2)
-        self.send_presence(pto=jid, ptype='subscribe')
+        for jid in jids:
+            self._outbound.acquire()
+            self.send_presence(pto=jid, ptype='subscribe')
 
     def _process_command(self, command, params, msg):
         """
         Processes command send by the user, handles async response.
         """
-        method = getattr(self, self._bot_commands[command])
+        entry = self._command_table[command]
+        method = entry.handler
 
         # handle privileges
-        if method._bot_min_privilege in ('manager', 'admin'):
+        if entry.allowed_groups is not None:
             jid = msg['from'].bare
-            user_groups = self.get_user_groups(jid)
-            if (method._bot_min_privilege == 'admin' and 'admin' not in user_groups) or\
-            (method._bot_min_privilege == 'manager' and 'admin' not in user_groups and 'manager' not in user_groups):
-
+            if not entry.allowed_groups & self._cached_user_groups(jid):
                 log.info('Insufficient privileges for user %s and method %s' % (jid, method.__name__))
+                COMMANDS.inc(command=command, result='denied')
                 return
 
         def _run_command(params, msg):
             output = None
+            result = 'error'
+            start = time.time()
             try:
-                output = method(*params)
+                with gevent.Timeout(entry.timeout, CommandTimeout):
+                    output = method(*params)
+                result = 'ok'
             except TypeError:
-                msg.reply("Wrong arguments received")
+                msg.reply("Wrong arguments received").send()
                 log.warning('Wrong arguments given to method %s (got %s)' % (method.__name__, params))
+            except CommandTimeout:
+                result = 'timeout'
+                msg.reply("Command timed out").send()
+                log.warning('Command %s timed out after %s seconds' % (method.__name__, entry.timeout))
+            finally:
+                COMMAND_SECONDS.observe(time.time() - start, command=command)
+                COMMANDS.inc(command=command, result=result)
 
             # reply with return value if not None
             if output is not None:
                 msg.reply(output).send()
 
-        # spawn new Greenlet when not running in blocking mode
-        if method._bot_async:
-            gevent.spawn(_run_command, params, msg)
-        else:
-            _run_command(params, msg)
+        # limits are applied per room occupant in groupchat
+        sender = msg['from'].full if msg['type'] == 'groupchat' else msg['from'].bare
+
+        # executor spawns new Greenlet when not running in blocking mode
+        rejection = self._command_executor.submit(sender, _run_command, params, msg, blocking=entry.blocking)
+        if rejection is not None:
+            COMMANDS.inc(command=command, result='throttled')
+            msg.reply(rejection).send()
 
     def _message_received(self, msg):
         """
         Handles messages received from user.
         """
-        if msg['type'] is None:
-            msg['type'] = 'normal'
+        msg_type = msg['type']
+        if msg_type is None:
+            msg_type = msg['type'] = 'normal'
+
+        if msg_type == 'groupchat':
+            prefix = self._chat_cmd_prefix
+            # ignore messages from self in groupchat
+            if msg['mucnick'] in self._active_nicknames:
+                return
+        elif msg_type in ('chat', 'normal'):
+            prefix = self._cmd_prefix
+        else:
+            return
 
-        if msg['type'] in ('chat', 'normal', 'groupchat'):
-            try:
-                prefix = self._chat_cmd_prefix if msg['type'] == 'groupchat' else self._cmd_prefix
-                # ignore messages from self in groupchat
-                if msg['type'] == 'groupchat' and msg['mucnick'] in self._active_nicknames:
-                    return
-
-                # process only messages starting with prefix
-                if msg['body'].startswith(prefix):
-                    body = msg['body'][len(prefix):]  # strip command prefix
-                    # get command and params by splitting using whitespace as a separator
-                    command, params = body.partition(' ')[0::2]
-
-                    method = getattr(self, self._bot_commands[command])  # raises AttributeError if method does not exist
-                    if method._bot_command:  # raises AttributeError if not bot command
-                        return self._process_command(command, method._bot_argsparser.parse_args(params), msg)
-            except (AttributeError, KeyError):
-                pass
+        # process only messages starting with prefix
+        body = msg['body']
+        if not body.startswith(prefix):
+            return
+
+        # get command and params by splitting using whitespace as a separator
+        command, _, params = body[len(prefix):].partition(' ')
+        entry = self._command_table.get(command)
+        if entry is not None:
+            return self._process_command(command, entry.args_parser.parse_args(params), msg)
 
     @bot_command
     def user_status(self, *users):
@@ -217,6 +298,17 @@ class XMPPBot(ClientXMPP, Greenlet):
 
         return output.rstrip('\n')
 
+    @bot_command
+    def users_with_status(self, status=None, group=None):
+        if status is None:
+            return "Please specify status"
+
+        if group is not None:
+            users = self.get_group_members(group, statuses=[status])
+        else:
+            users = sorted(self.presence.with_status(status))
+        return "\n".join(users) or "No users with status %s" % status
+
     @bot_command
     def users_in_roster(self, *args):
         roster_dict = dict(self.client_roster)
@@ -231,9 +323,18 @@ class XMPPBot(ClientXMPP, Greenlet):
         nickname = 'Marie' if nickname is None else nickname
         self.join_chat_room(room, nickname, password)
 
-    @bot_command
+    @bot_command(timeout=5)
     def server_uptime(self):
-        return subprocess.check_output('uptime').rstrip('\n')
+        # subprocess is not patched by gevent 0.13, the process is polled so the command timeout can interrupt it
+        process = subprocess.Popen('uptime', stdout=subprocess.PIPE)
+        try:
+            while process.poll() is None:
+                gevent.sleep(0.05)
+        finally:
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+        return process.stdout.read().rstrip('\n')
 
     @bot_command(min_privilege='manager')
     def bot_uptime(self):
@@ -244,6 +345,7 @@ class XMPPBot(ClientXMPP, Greenlet):
         return u"Bot uptime: %(hour)02d:%(min)02d:%(sec)02d" % {'hour': hours, 'min': minutes, 'sec': seconds}
 
     def _run(self):
+        self._outbound.start()
         self.connect()
         try:
             # as `threaded` is now deprecated, it could later be removed and this command should start working.
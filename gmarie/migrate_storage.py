@@ -0,0 +1,17 @@
+import logging
+import sys
+
+from marie.db import DataStorage
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(message)s')
+
+    # usage: migrate_storage.py [host [port [db]]]
+    args = sys.argv[1:]
+    config = dict(zip(('host', 'port', 'db'), args))
+    if 'port' in config:
+        config['port'] = int(config['port'])
+
+    migrated = DataStorage(**config).migrate_questions()
+    logging.info('Migrated %d questions to binary records' % migrated)
@@ -2,18 +2,56 @@ import gevent.monkey
 gevent.monkey.patch_all()
 
 import logging
+import sys
+import gevent
 
 import marie
 from marie.listeners.http import HttpListener
 from marie.eventbot import EventBot
 from marie.db import DataStorage
+from marie.cluster import BotCluster, ClusterWorker
+
+# accounts used in multi-worker mode (start.py --cluster), one worker process is started for every account
+WORKERS = [
+    ('marie.example@jabber.cz', 'g9ihyx95pHrgpgssFN2d'),
+]
+
+
+def run_worker(jid, password):
+    with marie.serve_forever() as m:
+        bot = EventBot(jid, password)
+        m.close_on_exit(bot.storage)
+        m.start(bot)
+        m.start(ClusterWorker(bot, [worker_jid for worker_jid, _ in WORKERS]))
+
+
+def run_cluster():
+    # fork workers before any connection is opened
+    for jid, password in WORKERS:
+        if gevent.fork() == 0:
+            return run_worker(jid, password)
+
+    with marie.serve_forever() as m:
+        storage = DataStorage()
+        m.close_on_exit(storage)
+        cluster = BotCluster([jid for jid, _ in WORKERS], storage)
+        m.start(cluster)
+
+        listener = HttpListener(cluster, 8088)
+        m.start(listener)
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(message)s')
+
+    if '--cluster' in sys.argv[1:]:
+        run_cluster()
+        sys.exit()
+
     with marie.serve_forever() as m:
         bot = EventBot('marie.example@jabber.cz', 'g9ihyx95pHrgpgssFN2d')
+        m.close_on_exit(bot.storage)
         m.start(bot)
 
         listener = HttpListener(bot, 8088)
-        m.start(listener)
\ No newline at end of file
+        m.start(listener)
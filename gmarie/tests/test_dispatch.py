@@ -0,0 +1,68 @@
+import random
+import unittest
+import gevent
+from marie.dispatch import EventDispatcher
+
+
+class EventDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = EventDispatcher(pool_size=10, queue_size=100)
+
+    def tearDown(self):
+        self.dispatcher.stop()
+
+    def test_keyed_events_keep_order_under_latency(self):
+        received = []
+
+        def callback(data):
+            # simulated storage latency, callbacks running concurrently would finish out of order
+            gevent.sleep(random.uniform(0, 0.01))
+            received.append(data)
+
+        messages = [('room-%d' % (i % 2), i) for i in range(30)]
+        for room, i in messages:
+            self.dispatcher.dispatch('groupchat_message_received', [callback], (room, i), key=room)
+        gevent.sleep(1)
+
+        for room in ('room-0', 'room-1'):
+            self.assertEqual([m for m in received if m[0] == room], [m for m in messages if m[0] == room])
+
+    def test_unkeyed_events_run_concurrently(self):
+        running = []
+
+        def callback(data):
+            running.append(data)
+            gevent.sleep(0.1)
+
+        for i in range(5):
+            self.dispatcher.dispatch('answer_received', [callback], i)
+        gevent.sleep(0.05)
+        self.assertEqual(len(running), 5)
+
+    def test_done_reports_result(self):
+        results = []
+
+        def failing(data):
+            raise ValueError(data)
+
+        self.dispatcher.dispatch('answer_received', [lambda data: None], 1, done=results.append)
+        self.dispatcher.dispatch('answer_received', [lambda data: None, failing], 2, done=results.append)
+        gevent.sleep(0.1)
+        self.assertEqual(sorted(results), [False, True])
+
+    def test_stop_waits_for_queued_events(self):
+        handled = []
+
+        def callback(data):
+            gevent.sleep(0.01)
+            handled.append(data)
+
+        dispatcher = EventDispatcher(pool_size=2)
+        for i in range(10):
+            dispatcher.dispatch('answer_received', [callback], i)
+        dispatcher.stop(timeout=5)
+        self.assertEqual(sorted(handled), list(range(10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import unittest
+from marie.filters import ChatroomFilter
+
+ROOM = 'room@conference.example.com'
+
+
+class ChatroomFilterTest(unittest.TestCase):
+    def make_filter(self, **filters):
+        return ChatroomFilter({ROOM: {'nickname': 'Marie', 'filters': filters}})
+
+    def test_mention_matches_whole_word(self):
+        chatroom_filter = self.make_filter(mention=True)
+        self.assertTrue(chatroom_filter.accepts(ROOM, 'john', u'Marie, are you there?'))
+        self.assertTrue(chatroom_filter.accepts(ROOM, 'john', u'ask marie'))
+        self.assertTrue(chatroom_filter.accepts(ROOM, 'john', u'@Marie: hello'))
+
+    def test_mention_ignores_nickname_inside_words(self):
+        chatroom_filter = self.make_filter(mention=True)
+        self.assertFalse(chatroom_filter.accepts(ROOM, 'john', u'Mariella is here'))
+        self.assertFalse(chatroom_filter.accepts(ROOM, 'john', u'primarie'))
+        self.assertFalse(chatroom_filter.accepts(ROOM, 'john', u'Mariečka'))
+
+    def test_keywords_and_nicks(self):
+        chatroom_filter = self.make_filter(keywords=['deploy'], deny_nicks=['bot'])
+        self.assertTrue(chatroom_filter.accepts(ROOM, 'john', u'Deploying now'))
+        self.assertFalse(chatroom_filter.accepts(ROOM, 'bot', u'deploy'))
+        self.assertFalse(chatroom_filter.accepts(ROOM, 'john', u'hello'))
+        self.assertTrue(chatroom_filter.accepts('other@conference.example.com', 'john', u'hello'))
+
+
+if __name__ == '__main__':
+    unittest.main()
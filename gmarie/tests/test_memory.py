@@ -0,0 +1,92 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import gevent
+from marie.memory import MemoryStorage
+
+
+class MemoryStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.storage = None
+
+    def tearDown(self):
+        if self.storage is not None:
+            self.storage.close()
+
+    def test_dialog_kept_for_question_grace(self):
+        self.storage = MemoryStorage(question_grace=600)
+        expires = datetime.datetime.now() - datetime.timedelta(seconds=60)
+        self.storage.save_answer_and_mapping('user@example.com', {'1': 'q1'}, answer=u'yes', expires=expires)
+        self.assertEqual(self.storage.load_answer_and_mapping('user@example.com'), ('yes', {'1': 'q1'}))
+
+    def test_dialog_dropped_after_question_grace(self):
+        self.storage = MemoryStorage(question_grace=30)
+        expires = datetime.datetime.now() - datetime.timedelta(seconds=60)
+        self.storage.save_answer_and_mapping('user@example.com', {'1': 'q1'}, answer=u'yes', expires=expires)
+        self.assertEqual(self.storage.load_answer_and_mapping('user@example.com'), (None, {}))
+
+
+class MemoryStorageJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'storage')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fill(self, storage):
+        expires = datetime.datetime(2030, 1, 1, 12, 0)
+        storage.set_questions([('user@example.com', 'q1', {'text': u'Question?', 'expires': expires}),
+                               ('user@example.com', 'q2', {'text': u'Other?'})])
+        storage.pop_questions([('user@example.com', 'q2')])
+        storage.push_queue('postbacks', [{'n': 1}, {'n': 2}, {'n': 3}])
+        storage.fetch_queue('postbacks', 'worker', 2)
+        storage.append_feed([{'answer': u'yes'}, {'answer': u'no'}])
+        storage.add_chatroom('room@conference.example.com', 'marie', None, 'http://example.com/')
+
+    def assert_filled(self, storage):
+        self.assertEqual(storage.get_questions('user@example.com'),
+                         {'q1': {'text': u'Question?', 'expires': datetime.datetime(2030, 1, 1, 12, 0)}})
+        self.assertEqual([data for _, data in storage.fetch_queue('postbacks', 'other', 10)], [{'n': 3}])
+        storage.restore_queue('postbacks', 'worker')
+        self.assertEqual([data['n'] for _, data in storage.fetch_queue('postbacks', 'worker', 10)], [1, 2])
+        self.assertEqual(storage.read_feed(0, 10), [(1, {'answer': 'yes'}), (2, {'answer': 'no'})])
+        self.assertEqual(list(storage.get_chatrooms()), ['room@conference.example.com'])
+
+    def test_changes_replayed_from_journal(self):
+        storage = MemoryStorage(self.path)
+        self.fill(storage)
+        storage.close()
+
+        storage = MemoryStorage(self.path)
+        self.assert_filled(storage)
+        storage.close()
+
+    def test_compaction_removes_old_journals(self):
+        storage = MemoryStorage(self.path, sync_interval=0.01, compact_size=1)
+        self.fill(storage)
+        gevent.sleep(0.5)
+        storage.close()
+
+        self.assertTrue(os.path.exists(self.path))
+        self.assertEqual(len([name for name in os.listdir(self.directory) if '.journal.' in name]), 1)
+        storage = MemoryStorage(self.path)
+        self.assert_filled(storage)
+        storage.close()
+
+    def test_incomplete_journal_record_ignored(self):
+        storage = MemoryStorage(self.path)
+        self.fill(storage)
+        storage.close()
+        with open(self.path + '.journal.1', 'ab') as f:
+            f.write('\x92\xa4push')
+
+        storage = MemoryStorage(self.path)
+        self.assert_filled(storage)
+        storage.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+import gevent
+from marie.postback import PostbackDispatcher
+
+
+class PostbackDispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.delivered = []
+        self.dispatcher = PostbackDispatcher(workers=4, per_host=1, durable=False)
+        self.dispatcher._post = self._post
+        self.dispatcher.start()
+
+    def tearDown(self):
+        self.dispatcher.stop()
+
+    def _post(self, host, job):
+        gevent.sleep(0.2 if host == 'slow.example.com' else 0.01)
+        self.delivered.append(job['data'])
+
+    def test_slow_host_does_not_block_workers(self):
+        for i in range(10):
+            self.dispatcher.submit('http://slow.example.com/', 'slow-%d' % i)
+        self.dispatcher.submit('http://fast.example.com/', 'fast')
+        gevent.sleep(0.1)
+        self.assertEqual(self.delivered, ['fast'])
+
+    def test_ordered_postbacks_delivered_in_order(self):
+        for i in range(5):
+            self.dispatcher.submit('http://fast.example.com/', i, ordering_key='room')
+            self.dispatcher.submit('http://fast.example.com/', 'other-%d' % i)
+        gevent.sleep(0.5)
+        self.assertEqual([data for data in self.delivered if isinstance(data, int)], list(range(5)))
+        self.assertEqual(len(self.delivered), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()